@@ -0,0 +1,393 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from glob import glob
+from typing import List, Tuple, Dict, Any, Optional
+
+import PIL
+
+from catalog import get_class_module
+from instrumentation import get_percentile
+from main import open_toml
+from pil_helpers import PageCompositor, TextBox, clear_caches, build_font, action_box, name_box, description_box, \
+    footnote_box, source_box, level_box, Palette, quantize_image, DEFAULT_PALETTE_COLORS
+
+# The shared boxes every class module fills in, and the TOML field each one shows
+BOXES = [
+    ("action_box", action_box, "action"),
+    ("name_box", name_box, "name"),
+    ("description_box", description_box, "description"),
+    ("footnote_box", footnote_box, "footnote"),
+    ("source_box", source_box, "source"),
+    ("level_box", level_box, "level"),
+]
+PERCENTILES = (50, 90, 99)
+# Fresh interpreters started to time startup, the cost paid by every build and every spawned worker process
+STARTUP_RUNS = 5
+
+
+class StageTimer:
+    """
+    Collects a latency sample every time a stage runs.
+    """
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        yield
+        self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            total = sum(samples)
+            summary[stage] = {
+                "count": len(samples),
+                "total_s": total,
+                "mean_ms": total / len(samples) * 1000,
+                "per_second": len(samples) / total if total else float("inf"),
+                "max_ms": samples[-1] * 1000,
+            }
+            for percentile in PERCENTILES:
+                summary[stage][f"p{percentile}_ms"] = get_percentile(samples, percentile) * 1000
+        return summary
+
+
+def get_peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_real_deck() -> List[Tuple[str, str]]:
+    """
+    @return [(str, str)]: Class name and TOML path of every ability in classes/*/abilities.
+    """
+    return [(toml_path.split(os.sep)[-3], toml_path) for toml_path in sorted(glob(os.path.join(
+        "classes", "*", "abilities", "*.toml")))]
+
+
+def write_synthetic_deck(count: int, folder: str, seed: int = 0) -> List[Tuple[str, str]]:
+    """
+    Writes count made-up ability TOMLs to folder, using words and field values taken from the real decks so that
+    text lengths and wrapping behave like real cards. Cards are spread across every class.
+
+    @return [(str, str)]: Class name and TOML path of each synthetic card.
+    """
+    rng = random.Random(seed)
+    real_cards = [open_toml(toml_path) for _, toml_path in get_real_deck()]
+    words = " ".join(card["description"] for card in real_cards).split()
+    names = [card["name"] for card in real_cards]
+    class_names = sorted({class_name for class_name, _ in get_real_deck()})
+    deck = []
+    for i in range(count):
+        paragraphs = [" ".join(rng.choices(words, k=rng.randint(5, 45))) for _ in range(rng.randint(1, 4))]
+        card = {
+            "name": rng.choice(names),
+            "source": rng.choice(real_cards)["source"],
+            "level": str(rng.randint(1, 20)),
+            "action": rng.choice(["Action", "Bonus Action", "Reaction", "Passive"]),
+            "cost": rng.choice(["", "", "1", "2"]),
+            "description": "\n\n".join(paragraphs),
+            "footnote": rng.choice(["", "Recovers on a Short Rest", "Recovers on a Long Rest"]),
+        }
+        toml_path = os.path.join(folder, f"synthetic_{i:05}.toml")
+        with open(toml_path, "w", encoding="utf-8") as f:
+            for key, value in card.items():
+                # JSON string escapes are all valid in TOML basic strings
+                f.write(f"{key} = {json.dumps(value, ensure_ascii=False)}\n")
+        deck.append((class_names[i % len(class_names)], toml_path))
+    return deck
+
+
+def run_deck(deck: List[Tuple[str, str]], cold: bool = False, palette: Optional[Palette] = None) -> Dict[str, Any]:
+    """
+    Runs every stage of the pipeline over the deck, timing each stage separately.
+
+    Args:
+        cold: Clear every in-memory cache before each card, to measure rendering from scratch.
+        palette: Also save every card and page as a palette PNG, and compare them with the truecolor ones.
+    """
+    timer = StageTimer()
+    palette_stats = {} if palette is not None else None
+    class_modules = {}
+    pages = {}
+    card_count = 0
+    start = time.perf_counter()
+    for class_name, toml_path in deck:
+        if class_name not in class_modules:
+            class_modules[class_name] = get_class_module(class_name)
+        class_module = class_modules[class_name]
+        layout = class_module.LAYOUT.compile()
+        scale = class_module.LAYOUT.scale
+        with timer.time("open_toml"):
+            toml_dict = open_toml(toml_path)
+        if toml_dict.get("skip"):
+            continue
+        if cold:
+            clear_caches()
+
+        with timer.time("get_template"):
+            im = layout.get_template(toml_dict)
+        # Text layout on its own, for the box that does the most of it
+        description = toml_dict["description"]
+        font = build_font(description_box.font_name, int(description_box.font_size * scale))
+        with timer.time("wrap_text"):
+            TextBox.wrap_text(description, font, int(description_box.width * scale))
+        with timer.time("shrink_font_until_text_fits"):
+            description_box.shrink_font_until_text_fits(
+                description, description_box.font_name, int(description_box.font_size * scale),
+                int(description_box.width * scale), int(description_box.height * scale), use_fit_cache=False)
+        for box_name, box, field in BOXES:
+            if field in toml_dict:
+                with timer.time(f"add_text[{box_name}]"):
+                    box.add_text(im, toml_dict[field], scale=scale)
+
+        # The whole card, the way build_card makes it
+        with timer.time("render_card"):
+            card = layout.render(toml_dict)
+        time_png_encode(timer, "card", card, palette, palette_stats)
+        card_count += 1
+
+        # Cards at 1.5x scale go on 2x2 pages, like main does with them
+        grid = (2, 2) if scale > 1 else (3, 3)
+        page_cards = pages.setdefault(grid, [])
+        page_cards.append(card)
+        if len(page_cards) == grid[0] * grid[1]:
+            run_page(timer, page_cards, grid, palette, palette_stats)
+            page_cards.clear()
+    for grid, page_cards in pages.items():
+        if page_cards:
+            run_page(timer, page_cards, grid, palette, palette_stats)
+    wall_time = time.perf_counter() - start
+    result = {
+        "cards": card_count,
+        "wall_s": wall_time,
+        "cards_per_second": card_count / wall_time if wall_time else float("inf"),
+        "peak_rss_bytes": get_peak_rss_bytes(),
+        "stages": timer.summary(),
+    }
+    if palette is not None:
+        result["palette"] = {"colors": palette.colors, "max_error": palette.max_error, **palette_stats}
+    return result
+
+
+def run_page(timer: StageTimer, cards: List, grid: Tuple[int, int], palette: Optional[Palette] = None,
+             palette_stats: Optional[Dict[str, Dict[str, float]]] = None):
+    with timer.time("save_page_composite"):
+        compositor = PageCompositor(grid, cut_line_width=10)
+        for slot, card in enumerate(cards):
+            compositor.add_card(card, slot)
+        page = compositor.finish_page()
+    time_png_encode(timer, "page", page, palette, palette_stats, dpi=(300, 300))
+
+
+def time_png_encode(timer: StageTimer, kind: str, image, palette: Optional[Palette] = None,
+                    palette_stats: Optional[Dict[str, Dict[str, float]]] = None, **params):
+    """
+    Times saving the image as a PNG. With a palette, also times quantizing it and saving it as a palette PNG, and adds
+    the sizes of both PNGs and how far the palette one strayed to palette_stats[kind].
+    """
+    buffer = io.BytesIO()
+    with timer.time(f"{kind}_png_encode"):
+        image.save(buffer, format="PNG", **params)
+    if palette is None:
+        return
+    truecolor_bytes = buffer.tell()
+    buffer = io.BytesIO()
+    with timer.time(f"{kind}_png_encode_palette"):
+        quantized, error = quantize_image(image, palette)
+        quantized.save(buffer, format="PNG", **params)
+    stats = palette_stats.setdefault(kind, {"count": 0, "truecolor_bytes": 0, "palette_bytes": 0,
+                                            "truecolor_fallbacks": 0, "mean_error": 0.0, "max_error": 0.0})
+    stats["count"] += 1
+    stats["truecolor_bytes"] += truecolor_bytes
+    stats["palette_bytes"] += buffer.tell()
+    stats["truecolor_fallbacks"] += quantized is image
+    stats["mean_error"] += (error - stats["mean_error"]) / stats["count"]
+    stats["max_error"] = max(stats["max_error"], error)
+
+
+def print_palette_report(name: str, result: Dict[str, Any]):
+    palette = result["palette"]
+    print(f"\n{name}: palette PNGs of {palette['colors']} colors against truecolor, falling back past an error of "
+          f"{palette['max_error']}")
+    print(f"{'':<8}{'count':>7}{'truecolor MiB':>15}{'palette MiB':>13}{'size':>7}{'truecolor ms':>14}"
+          f"{'palette ms':>12}{'speedup':>9}{'mean err':>10}{'max err':>9}{'fallbacks':>11}")
+    for kind in ("card", "page"):
+        stats = palette.get(kind)
+        if stats is None:
+            continue
+        truecolor_ms = result["stages"][f"{kind}_png_encode"]["mean_ms"]
+        palette_ms = result["stages"][f"{kind}_png_encode_palette"]["mean_ms"]
+        print(f"{kind:<8}{stats['count']:>7}{stats['truecolor_bytes'] / 2 ** 20:>15.1f}"
+              f"{stats['palette_bytes'] / 2 ** 20:>13.1f}{stats['palette_bytes'] / stats['truecolor_bytes']:>7.0%}"
+              f"{truecolor_ms:>14.1f}{palette_ms:>12.1f}{truecolor_ms / palette_ms:>8.1f}x"
+              f"{stats['mean_error']:>10.2f}{stats['max_error']:>9.2f}{stats['truecolor_fallbacks']:>11}")
+
+
+def measure_startup(toml_path: str, runs: int = STARTUP_RUNS) -> Dict[str, Any]:
+    """
+    Times importing main, and importing it then rendering one card, in fresh interpreters. Also lists the modules
+    that take longest to import, as reported by python -X importtime.
+    """
+    class_name = toml_path.split(os.sep)[-3]
+    statements = {
+        "import_main_ms": "import main",
+        "first_card_ms": f"import main; main.build_card(main.get_class_module({class_name!r}), {toml_path!r})",
+    }
+    result = {}
+    for key, statement in statements.items():
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", statement], check=True, stdout=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start)
+        result[key] = statistics.median(samples) * 1000
+    # Lines look like "import time:       self [us] |  cumulative | imported package"
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], check=True,
+                            stderr=subprocess.PIPE, text=True).stderr
+    imports = []
+    for line in stderr.splitlines()[1:]:
+        if line.startswith("import time:"):
+            self_us, cumulative_us, module = line.split(":", 1)[1].split("|")
+            imports.append((module.strip(), int(self_us) / 1000, int(cumulative_us) / 1000))
+    result["slowest_imports"] = sorted(imports, key=lambda item: item[1], reverse=True)[:10]
+    return result
+
+
+def print_startup_report(result: Dict[str, Any]):
+    print(f"\nstartup: import main {result['import_main_ms']:.0f} ms, import main and render a card "
+          f"{result['first_card_ms']:.0f} ms (medians, including interpreter start)")
+    print(f"{'slowest imports':<32}{'self ms':>10}{'cumul. ms':>10}")
+    for module, self_ms, cumulative_ms in result["slowest_imports"]:
+        print(f"{module:<32}{self_ms:>10.1f}{cumulative_ms:>10.1f}")
+
+
+def print_report(name: str, result: Dict[str, Any]):
+    print(f"\n{name}: {result['cards']} cards in {result['wall_s']:.2f}s ({result['cards_per_second']:.1f} cards/s), "
+          f"peak RSS {result['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+    header = f"{'stage':<32}{'count':>7}{'per sec':>10}{'mean ms':>10}" + "".join(
+        f"{f'p{p} ms':>10}" for p in PERCENTILES) + f"{'max ms':>10}"
+    print(header)
+    for stage, stats in result["stages"].items():
+        print(f"{stage:<32}{stats['count']:>7}{stats['per_second']:>10.1f}{stats['mean_ms']:>10.2f}" + "".join(
+            f"{stats[f'p{p}_ms']:>10.2f}" for p in PERCENTILES) + f"{stats['max_ms']:>10.2f}")
+
+
+def compare_results(baseline_path: str, current_path: str, threshold: float = 0.1) -> bool:
+    """
+    Prints how each stage's mean and p90 latency changed between two saved runs.
+
+    @return bool: True if any stage got slower by more than threshold (a fraction, so 0.1 is 10%).
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+    regressed = False
+    if "startup" in baseline and "startup" in current:
+        print("\nstartup:")
+        for key in ("import_main_ms", "first_card_ms"):
+            old, new = baseline["startup"][key], current["startup"][key]
+            change = (new - old) / old if old else 0.0
+            flagged = change > threshold
+            print(f"{key:<32}{old:>8.0f} -> {new:>6.0f} {change:>+4.0%}" + ("  REGRESSION" if flagged else ""))
+            regressed |= flagged
+    for deck_name, current_deck in current["decks"].items():
+        baseline_deck = baseline["decks"].get(deck_name)
+        if baseline_deck is None:
+            print(f"\n{deck_name}: not in {baseline_path}, skipping")
+            continue
+        print(f"\n{deck_name}:")
+        print(f"{'stage':<32}{'mean ms':>20}{'p90 ms':>20}")
+        for stage, stats in current_deck["stages"].items():
+            baseline_stats = baseline_deck["stages"].get(stage)
+            if baseline_stats is None:
+                continue
+            line = f"{stage:<32}"
+            flagged = False
+            for key in ("mean_ms", "p90_ms"):
+                old, new = baseline_stats[key], stats[key]
+                change = (new - old) / old if old else 0.0
+                line += f"{old:>8.2f} -> {new:>6.2f} {change:>+4.0%}"
+                flagged |= change > threshold
+            print(line + ("  REGRESSION" if flagged else ""))
+            regressed |= flagged
+        old_rss, new_rss = baseline_deck["peak_rss_bytes"], current_deck["peak_rss_bytes"]
+        print(f"{'peak RSS MiB':<32}{old_rss / 2 ** 20:>8.0f} -> {new_rss / 2 ** 20:>6.0f}")
+    return regressed
+
+
+def main(synthetic: int = 0, real: bool = True, cold: bool = False, output: Optional[str] = None, seed: int = 0,
+         startup: bool = True, palette: Optional[Palette] = None):
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cold": cold,
+        },
+        "decks": {},
+    }
+    if startup:
+        results["startup"] = measure_startup(get_real_deck()[0][1])
+        print_startup_report(results["startup"])
+    if real:
+        results["decks"]["real"] = run_deck(get_real_deck(), cold=cold, palette=palette)
+        print_report("real", results["decks"]["real"])
+        if palette is not None:
+            print_palette_report("real", results["decks"]["real"])
+    if synthetic:
+        with tempfile.TemporaryDirectory() as folder:
+            deck = write_synthetic_deck(synthetic, folder, seed=seed)
+            name = f"synthetic_{synthetic}"
+            results["decks"][name] = run_deck(deck, cold=cold, palette=palette)
+            print_report(name, results["decks"][name])
+            if palette is not None:
+                print_palette_report(name, results["decks"][name])
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the card rendering pipeline.")
+    parser.add_argument("--synthetic", type=int, default=0, metavar="N",
+                        help="Also run a synthetic deck of N cards built from words in the real decks")
+    parser.add_argument("--no-real", dest="real", action="store_false", help="Skip the real classes/*/abilities decks")
+    parser.add_argument("--cold", action="store_true", help="Clear in-memory caches before every card")
+    parser.add_argument("--no-startup", dest="startup", action="store_false",
+                        help="Skip timing imports and startup in fresh interpreters")
+    parser.add_argument("--palette", type=int, nargs="?", const=DEFAULT_PALETTE_COLORS, metavar="COLORS",
+                        help="Also save every card and page as a palette PNG of up to COLORS colors (default: "
+                             f"{DEFAULT_PALETTE_COLORS}), and report sizes, timings and errors against truecolor")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic deck")
+    parser.add_argument("--output", "-o", help="Save results as JSON to this path")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="Compare two saved results instead of running, exiting with 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown, as a fraction, that counts as a regression when comparing (default: 0.1)")
+    args = parser.parse_args()
+    if args.palette is not None and not 2 <= args.palette <= 256:
+        parser.error(f"argument --palette: {args.palette} colors, expected 2-256")
+    if args.compare:
+        sys.exit(1 if compare_results(*args.compare, threshold=args.threshold) else 0)
+    main(synthetic=args.synthetic, real=args.real, cold=args.cold, output=args.output, seed=args.seed,
+         startup=args.startup, palette=Palette(args.palette) if args.palette else None)
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from types import ModuleType
+from typing import Dict, Any, Optional, List, Tuple
+
+from manifest import get_class_input_paths, hash_file, hash_values
+from pil_helpers import get_render_scale, Palette
+
+CARD_STORE_FOLDER = os.path.join(".cache", "cards")
+# Bump whenever what goes into a key changes
+CARD_STORE_VERSION = 2
+# Entries that haven't been used for this long are removed by gc
+DEFAULT_MAX_AGE_DAYS = 30
+# Fields that decide whether a card gets built, but not how it looks
+UNDRAWN_FIELDS = ("skip",)
+
+
+def link_or_copy(source: str, destination: str):
+    """
+    Hard links destination to source, or copies it where links aren't possible (e.g. across filesystems). Anything
+    already at destination is replaced.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class CardStore:
+    """
+    Every card rendered by any build, saved as a PNG named by a hash of everything that goes into drawing it: the
+    card's fields, the class module and layout code, templates, class icon and fonts, the scale, and the palette it was
+    saved with, if any. A build that needs a card with the same hash links the stored PNG into its output folder
+    instead of rendering it again, whether it's the same card from an earlier build, the same card in another output
+    folder, or another card that happens to draw exactly the same.
+
+    Stored cards are hard links to the PNGs in the output folders where possible, so they take up no extra space. That
+    means card PNGs in the output folders must be removed before being written again, never written over in place.
+
+    The index records each card's size, how long it took to render, when it was last used and how many times it's
+    been reused, along with running totals of what reusing cards has saved.
+    """
+
+    def __init__(self, folder: str = CARD_STORE_FOLDER):
+        self.folder = folder
+        self.index_path = os.path.join(folder, "index.json")
+        self._class_digests = {}
+        # Cards rendered this build, added to the store by save once they've been written
+        self._rendered: List[Tuple[str, str, float]] = []
+        # Cards of this build that draw the same as one rendered earlier in it, linked to its PNG by save
+        self._duplicates: List[Tuple[str, str]] = []
+        # What reusing cards saved in this build
+        self.session = Counter()
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") != CARD_STORE_VERSION:
+            data = {}
+        self.entries: Dict[str, Dict[str, Any]] = data.get("entries", {})
+        self.totals = Counter(data.get("totals", {}))
+
+    def get_key(self, class_name: str, class_module: ModuleType, toml_dict: Dict[str, Any], scale: float,
+                palette: Optional[Palette] = None) -> str:
+        # Only what the inputs contain matters, not where they live, so classes sharing a module, templates and
+        # fonts share cards
+        if class_name not in self._class_digests:
+            paths = get_class_input_paths(class_name, class_module)
+            self._class_digests[class_name] = hash_values([hash_file(p) for p in paths])
+        fields = {k: v for k, v in toml_dict.items() if k not in UNDRAWN_FIELDS}
+        return hash_values([CARD_STORE_VERSION, self._class_digests[class_name], json.dumps(fields, sort_keys=True),
+                            scale, get_render_scale(), palette])
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], f"{key}.png")
+
+    def get(self, key: str, output_path: str) -> bool:
+        """
+        Puts the stored card with this key at output_path, if there is one.
+
+        @return bool: Whether the card was in the store.
+        """
+        entry = self.entries.get(key)
+        if entry is None or not os.path.isfile(self.get_path(key)):
+            return False
+        link_or_copy(self.get_path(key), output_path)
+        self._record_reuse(entry)
+        return True
+
+    def add(self, key: str, output_path: str, render_seconds: float):
+        """
+        Adds a card that was just rendered to output_path, once it's been written (see save).
+        """
+        self._rendered.append((key, output_path, render_seconds))
+
+    def add_duplicate(self, key: str, output_path: str):
+        """
+        Puts the card being rendered this build with this key at output_path as well, once it's been written (see
+        save).
+        """
+        self._duplicates.append((key, output_path))
+
+    def _record_reuse(self, entry: Dict[str, Any]):
+        entry["hits"] += 1
+        entry["last_used"] = time.time()
+        for counter in (self.session, self.totals):
+            counter["hits"] += 1
+            counter["render_seconds_saved"] += entry["render_seconds"]
+            counter["bytes_saved"] += entry["size"]
+
+    def save(self):
+        """
+        Adds the cards rendered this build to the store, and writes the index. Call once every card has been written.
+        """
+        for key, output_path, render_seconds in self._rendered:
+            if not os.path.isfile(output_path):
+                continue
+            store_path = self.get_path(key)
+            if key not in self.entries or not os.path.isfile(store_path):
+                os.makedirs(os.path.dirname(store_path), exist_ok=True)
+                link_or_copy(output_path, store_path)
+                self.entries[key] = {"size": os.path.getsize(store_path), "render_seconds": render_seconds,
+                                     "hits": 0, "last_used": time.time()}
+            self.session["rendered"] += 1
+        for key, output_path in self._duplicates:
+            if key in self.entries and os.path.isfile(self.get_path(key)):
+                link_or_copy(self.get_path(key), output_path)
+                self._record_reuse(self.entries[key])
+        self._rendered.clear()
+        self._duplicates.clear()
+        self._write_index()
+
+    def _write_index(self):
+        os.makedirs(self.folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": CARD_STORE_VERSION, "entries": self.entries, "totals": self.totals}, f)
+        os.replace(temp_path, self.index_path)
+
+    def gc(self, max_age_days: float = DEFAULT_MAX_AGE_DAYS, max_bytes: Optional[int] = None) -> Tuple[int, int]:
+        """
+        Removes cards that haven't been used for max_age_days, then the least recently used cards until the store is
+        no bigger than max_bytes, along with any PNGs the index doesn't know about.
+
+        @return (int, int): The number of cards removed, and the bytes freed. Cards still linked into an output
+            folder don't free anything until those PNGs go too.
+        """
+        removed = freed = 0
+        oldest = time.time() - max_age_days * 24 * 60 * 60
+        total_bytes = sum(entry["size"] for entry in self.entries.values())
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]["last_used"]):
+            if entry["last_used"] >= oldest and (max_bytes is None or total_bytes <= max_bytes):
+                break
+            freed += self._remove_file(self.get_path(key))
+            total_bytes -= entry["size"]
+            del self.entries[key]
+            removed += 1
+        for folder, _, filenames in os.walk(self.folder, topdown=False):
+            for filename in filenames:
+                if filename.endswith(".png") and filename[:-len(".png")] not in self.entries:
+                    freed += self._remove_file(os.path.join(folder, filename))
+                    removed += 1
+            if folder != self.folder and not os.listdir(folder):
+                os.rmdir(folder)
+        self._write_index()
+        return removed, freed
+
+    @staticmethod
+    def _remove_file(path: str) -> int:
+        """
+        @return int: The bytes freed, which is none if the file has other links.
+        """
+        try:
+            stat = os.stat(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return stat.st_size if stat.st_nlink == 1 else 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        sizes = [entry["size"] for entry in self.entries.values()]
+        linked = 0
+        for key in self.entries:
+            try:
+                linked += os.stat(self.get_path(key)).st_nlink > 1
+            except FileNotFoundError:
+                pass
+        return {
+            "cards": len(self.entries),
+            "bytes": sum(sizes),
+            "linked_into_output": linked,
+            "hits": self.totals["hits"],
+            "render_seconds_saved": self.totals["render_seconds_saved"],
+            "bytes_saved": self.totals["bytes_saved"],
+        }
+
+    def print_session_summary(self):
+        print(f"Card store: reused {self.session['hits']} cards and rendered {self.session['rendered']}, saving "
+              f"{self.session['render_seconds_saved']:.2f}s of rendering and "
+              f"{self.session['bytes_saved'] / 2 ** 20:.1f} MB of PNGs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show what the card store has saved, or clear out old cards.")
+    parser.add_argument("--gc", action="store_true", help="Remove cards that haven't been used in a while")
+    parser.add_argument("--max-age-days", type=float, default=DEFAULT_MAX_AGE_DAYS,
+                        help=f"With --gc, remove cards unused for this many days (default: {DEFAULT_MAX_AGE_DAYS})")
+    parser.add_argument("--max-size-mb", type=float,
+                        help="With --gc, also remove the least recently used cards until the store is this small")
+    args = parser.parse_args()
+    store = CardStore()
+    if args.gc:
+        max_bytes = int(args.max_size_mb * 2 ** 20) if args.max_size_mb is not None else None
+        removed, freed = store.gc(args.max_age_days, max_bytes)
+        print(f"Removed {removed} cards, freeing {freed / 2 ** 20:.1f} MB\n")
+    stats = store.get_stats()
+    print(f"Cards stored:          {stats['cards']} ({stats['bytes'] / 2 ** 20:.1f} MB, "
+          f"{stats['linked_into_output']} shared with an output folder)")
+    print(f"Cards reused:          {stats['hits']}")
+    print(f"Rendering saved:       {stats['render_seconds_saved']:.1f}s")
+    print(f"PNG encoding saved:    {stats['bytes_saved'] / 2 ** 20:.1f} MB")
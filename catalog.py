@@ -0,0 +1,180 @@
+import argparse
+import importlib
+import json
+import os
+import tempfile
+import tomllib
+from glob import glob
+from types import ModuleType
+from typing import List, Optional, Dict, Any, Iterable
+
+from pil_helpers import get_file_signature
+
+CATALOG_PATH = os.path.join(".cache", "catalog.json")
+# Bump whenever the fields stored for each card change
+CATALOG_VERSION = 1
+
+
+def get_class_names() -> List[str]:
+    """
+    @return [str]: Every class with a module at classes/<class>/src.py, found without importing any of them.
+    """
+    return sorted(os.path.basename(os.path.dirname(path)) for path in glob(os.path.join("classes", "*", "src.py")))
+
+
+def get_class_module(class_name: str) -> ModuleType:
+    """
+    Imports a class module the first time it's asked for, so a build only pays for the classes it uses.
+    """
+    if not os.path.isfile(os.path.join("classes", class_name, "src.py")):
+        raise ValueError(f"Unknown class: {class_name}. Expected one of {get_class_names()}")
+    return importlib.import_module(f"classes.{class_name}.src")
+
+
+class Catalog:
+    """
+    Index of every ability TOML under classes/*/abilities, holding just the fields used to pick which cards to build:
+    name, class, level, action and skip flag, along with the file's size and mtime.
+
+    The index is kept on disk, and update only parses TOMLs that are new or have changed since it was last saved, so
+    selecting cards doesn't mean reading every file. Only classes that have been updated can be selected from
+    reliably; the others may be out of date.
+    """
+
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self._dirty = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.entries: Dict[str, Dict[str, Any]] = data.get("entries", {}) if data.get("version") == CATALOG_VERSION \
+            else {}
+
+    def update(self, class_names: Optional[Iterable[str]] = None) -> int:
+        """
+        Brings the index up to date with the files on disk.
+
+        Args:
+            class_names: Only update these classes, so that nothing else's TOMLs are read, and a broken ability file
+                in another class doesn't stop these being built. Every class if not given.
+
+        @return int: The number of TOMLs that had to be parsed.
+        """
+        parsed = 0
+        if class_names is None:
+            toml_paths = set(glob(os.path.join("classes", "*", "abilities", "*.toml")))
+            indexed_paths = set(self.entries)
+        else:
+            class_names = set(class_names)
+            toml_paths = set()
+            for class_name in class_names:
+                toml_paths.update(glob(os.path.join("classes", class_name, "abilities", "*.toml")))
+            indexed_paths = {toml_path for toml_path, entry in self.entries.items()
+                             if entry["class_name"] in class_names}
+        for toml_path in indexed_paths - toml_paths:
+            del self.entries[toml_path]
+            self._dirty = True
+        for toml_path in toml_paths:
+            signature = list(get_file_signature(toml_path))
+            entry = self.entries.get(toml_path)
+            if entry is not None and entry["signature"] == signature:
+                continue
+            with open(toml_path, "rb") as f:
+                toml_dict = tomllib.load(f)
+            self.entries[toml_path] = {
+                "class_name": toml_path.split(os.sep)[-3],
+                "filename": os.path.basename(toml_path).replace(".toml", ""),
+                "name": toml_dict.get("name"),
+                # Levels are strings in the TOMLs, and blank for cards that don't have one
+                "level": int(toml_dict["level"]) if toml_dict.get("level") else None,
+                "action": toml_dict.get("action"),
+                "skip": bool(toml_dict.get("skip")),
+                "signature": signature,
+            }
+            self._dirty = True
+            parsed += 1
+        return parsed
+
+    def select(self, class_names: Optional[Iterable[str]] = None, minimum_level: Optional[int] = None,
+               maximum_level: Optional[int] = None, actions: Optional[Iterable[str]] = None,
+               filenames: Optional[Iterable[str]] = None, names: Optional[Iterable[str]] = None,
+               include_skipped: bool = False) -> List[str]:
+        """
+        Finds the cards matching every filter given. Cards without a level match any level range, the same way
+        build_card never filters them out.
+
+        Args:
+            filenames: TOML filenames without the extension, e.g. superiority_dice
+            names: Card names, as shown on the card
+            include_skipped: Also return cards marked with skip = true
+
+        @return [str]: TOML paths of the matching cards, sorted.
+        """
+        class_names = set(class_names) if class_names is not None else None
+        actions = set(actions) if actions is not None else None
+        filenames = set(filenames) if filenames else None
+        names = set(names) if names else None
+        toml_paths = []
+        for toml_path, entry in self.entries.items():
+            if entry["skip"] and not include_skipped:
+                continue
+            if class_names is not None and entry["class_name"] not in class_names:
+                continue
+            if entry["level"] is not None and (
+                    (minimum_level is not None and entry["level"] < minimum_level)
+                    or (maximum_level is not None and entry["level"] > maximum_level)):
+                continue
+            if actions is not None and entry["action"] not in actions:
+                continue
+            if filenames is not None and entry["filename"] not in filenames:
+                continue
+            if names is not None and entry["name"] not in names:
+                continue
+            toml_paths.append(toml_path)
+        return sorted(toml_paths)
+
+    def save(self):
+        if not self._dirty:
+            return
+        folder = os.path.dirname(self.path)
+        os.makedirs(folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": CATALOG_VERSION, "entries": self.entries}, f)
+        os.replace(temp_path, self.path)
+        self._dirty = False
+
+
+def load_catalog(class_names: Optional[Iterable[str]] = None, path: str = CATALOG_PATH) -> Catalog:
+    """
+    Args:
+        class_names: Only update these classes. Every class if not given.
+
+    @return Catalog: The saved catalog, updated and saved again if anything changed.
+    """
+    catalog = Catalog(path)
+    catalog.update(class_names)
+    catalog.save()
+    return catalog
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the cards matching a selection, without parsing every TOML.")
+    parser.add_argument("--class", dest="class_names", action="append", metavar="CLASS",
+                        help="Only cards of this class. Can be given more than once")
+    parser.add_argument("--minimum-level", type=int)
+    parser.add_argument("--maximum-level", type=int)
+    parser.add_argument("--action", dest="actions", action="append", metavar="ACTION",
+                        help="Only cards with this action type, e.g. \"Bonus Action\". Can be given more than once")
+    parser.add_argument("--name", dest="names", action="append", metavar="NAME",
+                        help="Only the card with this name. Can be given more than once")
+    parser.add_argument("--include-skipped", action="store_true", help="Also list cards marked with skip = true")
+    args = parser.parse_args()
+    catalog = load_catalog(args.class_names)
+    for toml_path in catalog.select(args.class_names, args.minimum_level, args.maximum_level, args.actions,
+                                    names=args.names, include_skipped=args.include_skipped):
+        entry = catalog.entries[toml_path]
+        level = entry["level"] if entry["level"] is not None else "-"
+        print(f"{entry['class_name']:<16}{level:>3}  {entry['action']:<14}{entry['name']}")
@@ -1,34 +1,28 @@
-import os.path
-from typing import Any
-
-from PIL import Image
-
-from pil_helpers import open_image, TextBox, action_box, name_box, description_box, source_box, level_box, footnote_box
+from pil_helpers import LayoutPlan, Template, Field, TextBox, action_box, name_box, description_box, source_box, \
+    level_box, footnote_box
 
 DEBUG_TEXT_BOX_BORDERS = False
 
 
-ki_box = TextBox(96, 46, 84, 82)
-name_box_w_ki = TextBox(206, 46, 517, 82)
-
-
-def get_template(toml_dict: dict[str, Any]) -> Image:
-    ki = "Ki_" if toml_dict["cost"] else ""
-    action = toml_dict["action"].replace(" ", "_")
-    filepath = f"templates/Template_{ki}{action}.png"
-    if not os.path.isfile(filepath):
-        filepath = "classes/monk/" + filepath
-    return open_image(filepath)
-
-
-def add_text(im: Image, toml_dict: dict[str, Any]):
-    action_box.add_text(im, toml_dict["action"])
-    if toml_dict["cost"]:
-        ki_box.add_text(im, toml_dict["cost"])
-        name_box_w_ki.add_text(im, toml_dict["name"])
-    else:
-        name_box.add_text(im, toml_dict["name"])
-    description_box.add_text(im, toml_dict["description"])
-    footnote_box.add_text(im, toml_dict["footnote"])
-    source_box.add_text(im, toml_dict["source"])
-    level_box.add_text(im, toml_dict["level"])
+ki_box = TextBox(96, 46, 84, 82, name="ki")
+name_box_w_ki = TextBox(206, 46, 517, 82, cache_rendered_text=False, name="name_w_ki")
+
+LAYOUT = LayoutPlan(
+    # Abilities that cost ki have their own templates, which live with the class when they aren't shared
+    templates=[
+        Template("templates/Template_Ki_{action}.png", when="cost"),
+        Template("classes/monk/templates/Template_Ki_{action}.png", when="cost"),
+        Template("templates/Template_{action}.png", unless="cost"),
+        Template("classes/monk/templates/Template_{action}.png", unless="cost"),
+    ],
+    fields=[
+        Field(action_box, "action"),
+        Field(ki_box, "cost", when="cost"),
+        Field(name_box_w_ki, "name", when="cost"),
+        Field(name_box, "name", unless="cost"),
+        Field(description_box, "description"),
+        Field(footnote_box, "footnote"),
+        Field(source_box, "source"),
+        Field(level_box, "level"),
+    ],
+)
@@ -1,20 +1,14 @@
-from typing import Any
-
-from PIL import Image
-
-from pil_helpers import open_image, action_box, name_box, description_box, source_box, level_box, footnote_box
-
-
-def get_template(toml_dict: dict[str, Any]) -> Image:
-    action = toml_dict["action"].replace(" ", "_")
-    filepath = f"templates/Template_{action}.png"
-    return open_image(filepath)
-
-
-def add_text(im: Image, toml_dict: dict[str, Any]):
-    action_box.add_text(im, toml_dict["action"])
-    name_box.add_text(im, toml_dict["name"])
-    description_box.add_text(im, toml_dict["description"])
-    footnote_box.add_text(im, toml_dict["footnote"])
-    source_box.add_text(im, toml_dict["source"])
-    level_box.add_text(im, toml_dict["level"])
+from pil_helpers import LayoutPlan, Template, Field, action_box, name_box, description_box, source_box, level_box, \
+    footnote_box
+
+LAYOUT = LayoutPlan(
+    templates=[Template("templates/Template_{action}.png")],
+    fields=[
+        Field(action_box, "action"),
+        Field(name_box, "name"),
+        Field(description_box, "description"),
+        Field(footnote_box, "footnote"),
+        Field(source_box, "source"),
+        Field(level_box, "level"),
+    ],
+)
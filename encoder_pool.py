@@ -0,0 +1,83 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from PIL import Image
+
+import instrumentation
+from pil_helpers import save_png
+
+# zlib lets go of the GIL while it compresses, so saves on these threads really do run alongside rendering
+ENCODER_THREADS = min(4, os.cpu_count() or 1)
+
+
+class EncoderPool:
+    """
+    Saves images from a few background threads, so that rendering carries on while earlier cards and pages are being
+    compressed and written.
+
+    At most max_pending images are waiting to be saved at once, and save blocks until there's room for another, so
+    memory stays capped however far ahead rendering gets. An error from a background save is raised again by a later
+    call to save, or by wait or close.
+    Images mustn't be changed once they've been handed over.
+    """
+
+    def __init__(self, threads: int = ENCODER_THREADS, max_pending: Optional[int] = None):
+        self.max_pending = max_pending or threads * 2
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="encoder")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = deque()
+
+    def __enter__(self) -> "EncoderPool":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Errors from saves still running shouldn't hide the one already on its way out
+        self.close(raise_errors=exc_type is None)
+
+    def save(self, image: Image.Image, filename: str, **params):
+        """
+        Queues the image to be saved to filename, with the same params as pil_helpers.save_png. Images saved with a
+        palette are quantized on the background thread too.
+        """
+        self._collect(wait=False)
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._save, image, filename, params)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+
+    @staticmethod
+    def _save(image: Image.Image, filename: str, params: dict):
+        # Whichever card the main thread is on has nothing to do with this save
+        with instrumentation.span("encode", file=filename, card=None):
+            save_png(image, filename, **params)
+
+    def _collect(self, wait: bool):
+        """
+        Forgets saves that have finished, in the order they were queued, raising the first error among them.
+
+        Args:
+            wait: Wait for every save to finish, rather than stopping at the first one still going.
+        """
+        while self._pending and (wait or self._pending[0].done()):
+            self._pending.popleft().result()
+
+    def wait(self):
+        """
+        Blocks until everything queued so far has been saved.
+        """
+        self._collect(wait=True)
+
+    def close(self, raise_errors: bool = True):
+        try:
+            if raise_errors:
+                self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._pending.clear()
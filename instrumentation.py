@@ -0,0 +1,178 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Optional, List, Dict, Any, Tuple
+
+# Shared do-nothing context manager, so that spans cost a single function call while tracing is off
+_NULL_SPAN = contextlib.nullcontext()
+
+_tracer = None
+
+
+class Tracer:
+    """
+    Records timing spans and counters while a build runs. Spans are kept as Chrome trace events ("ph": "X"), so the
+    trace file can be opened in chrome://tracing or Perfetto. Every span is tagged with the card being rendered.
+    """
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.counters = Counter()
+        self.card: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **args) -> "Span":
+        return Span(self, name, args)
+
+    def card_span(self, card: str, **args) -> "CardSpan":
+        return CardSpan(self, card, args)
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_event(self, event: Dict[str, Any]):
+        with self._lock:
+            self.events.append(event)
+
+    def drain(self) -> Tuple[List[Dict[str, Any]], Counter]:
+        """
+        Takes everything recorded so far, e.g. to send it from a worker process back to the main one.
+        """
+        with self._lock:
+            events, counters = self.events, self.counters
+            self.events, self.counters = [], Counter()
+        return events, counters
+
+    def merge(self, events: List[Dict[str, Any]], counters: Counter):
+        with self._lock:
+            self.events.extend(events)
+            self.counters.update(counters)
+
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer: Tracer, name: str, args: Dict[str, Any]):
+        self.tracer, self.name, self.args = tracer, name, args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.perf_counter_ns() - self.start
+        self.args.setdefault("card", self.tracer.card)
+        self.tracer.add_event({
+            "name": self.name,
+            "ph": "X",
+            "ts": self.start / 1000,
+            "dur": duration / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": self.args,
+        })
+
+
+class CardSpan(Span):
+    """
+    Span around everything done for one card. Spans inside it are tagged with the card, and it records how much
+    each counter went up while the card was being built.
+    """
+    __slots__ = ("counters_before",)
+
+    def __init__(self, tracer: Tracer, card: str, args: Dict[str, Any]):
+        super().__init__(tracer, "card", args)
+        self.args["name"] = card
+
+    def __enter__(self):
+        self.tracer.card = self.args["name"]
+        self.counters_before = Counter(self.tracer.counters)
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        counters = Counter(self.tracer.counters)
+        counters.subtract(self.counters_before)
+        self.args["counters"] = {name: n for name, n in counters.items() if n}
+        self.tracer.card = None
+
+
+def enable() -> Tracer:
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def span(name: str, **args):
+    """
+    Times the code inside the with block, if tracing is on.
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, **args)
+
+
+def card_span(card: str, **args):
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.card_span(card, **args)
+
+
+def count(name: str, n: int = 1):
+    if _tracer is not None:
+        _tracer.count(name, n)
+
+
+def write_trace(path: str):
+    """
+    Writes every span recorded so far as a Chrome trace file, with the counter totals alongside.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": _tracer.events, "displayTimeUnit": "ms", "counters": dict(_tracer.counters)}, f)
+
+
+def get_slowest_cards(n: int) -> List[Dict[str, Any]]:
+    """
+    @return [dict]: The args of the n slowest card spans, slowest first, along with their duration in microseconds.
+    """
+    cards = [dict(event["args"], dur=event["dur"]) for event in _tracer.events if event["name"] == "card"]
+    return sorted(cards, key=lambda card: card["dur"], reverse=True)[:n]
+
+
+def print_summary(slowest_cards: int = 5):
+    durations = defaultdict(list)
+    for event in _tracer.events:
+        durations[event["name"]].append(event["dur"] / 1000)
+    print(f"\n{'span':<24}{'count':>8}{'total ms':>12}{'mean ms':>10}{'max ms':>10}")
+    for name, samples in sorted(durations.items(), key=lambda item: sum(item[1]), reverse=True):
+        print(f"{name:<24}{len(samples):>8}{sum(samples):>12.1f}{sum(samples) / len(samples):>10.2f}"
+              f"{max(samples):>10.2f}")
+    if _tracer.counters:
+        print(f"\n{'counter':<24}{'total':>8}")
+        for name, n in sorted(_tracer.counters.items()):
+            print(f"{name:<24}{n:>8}")
+    if slowest_cards:
+        print("\nSlowest cards:")
+        for card in get_slowest_cards(slowest_cards):
+            print(f"  {card['dur'] / 1000:>8.1f} ms  {card['name']}  {card.get('counters', {})}")
+
+
+def get_percentile(sorted_samples: List[float], percentile: float) -> float:
+    # Nearest-rank percentile
+    index = max(0, min(len(sorted_samples) - 1, round(percentile / 100 * len(sorted_samples)) - 1))
+    return sorted_samples[index]
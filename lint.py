@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import time
+from glob import glob
+from typing import List, Optional
+
+from catalog import get_class_names, get_class_module
+from main import open_toml
+from pil_helpers import LayoutRecorder, LayoutMeasurement, save_fit_cache
+
+# Font sizes below this, before scaling, are too small to read comfortably once printed
+MIN_FONT_SIZE = 20
+
+
+def measure_card(class_module, toml_path: str) -> Optional[List[LayoutMeasurement]]:
+    """
+    Runs the class module's layout plan over the card without drawing anything.
+
+    @return [LayoutMeasurement]: One for each text box on the card, or None if the card is skipped.
+    """
+    toml_dict = open_toml(toml_path)
+    if toml_dict.get("skip"):
+        return None
+    recorder = LayoutRecorder()
+    class_module.LAYOUT.compile().add_text(recorder, toml_dict)
+    return recorder.measurements
+
+
+def get_problems(measurement: LayoutMeasurement, min_font_size: int = MIN_FONT_SIZE) -> List[str]:
+    problems = []
+    if measurement.overflows:
+        problems.append("OVERFLOW")
+    if measurement.font_size < min_font_size * measurement.scale:
+        problems.append("SMALL FONT")
+    return problems
+
+
+def lint(class_names: List[str], min_font_size: int = MIN_FONT_SIZE, problems_only: bool = False) -> int:
+    """
+    Measures every card of the given classes and prints the font size, line count and fill ratio of each box, with
+    any problems flagged.
+
+    @return int: The number of boxes with problems.
+    """
+    problem_count = card_count = 0
+    start = time.perf_counter()
+    print(f"{'card':<48}{'box':<14}{'font':>6}{'lines':>7}{'fill':>7}  problems")
+    for class_name in class_names:
+        class_module = get_class_module(class_name)
+        for toml_path in sorted(glob(f"classes/{class_name}/abilities/*.toml")):
+            measurements = measure_card(class_module, toml_path)
+            if measurements is None:
+                continue
+            card_count += 1
+            card_name = f"{class_name}/{os.path.basename(toml_path).replace('.toml', '')}"
+            for measurement in measurements:
+                problems = get_problems(measurement, min_font_size)
+                problem_count += len(problems) > 0
+                if problems_only and not problems:
+                    continue
+                print(f"{card_name:<48}{measurement.box:<14}{measurement.font_size:>6}{measurement.line_count:>7}"
+                      f"{measurement.fill_ratio:>7.0%}  {', '.join(problems)}")
+    save_fit_cache()
+    print(f"\nChecked {card_count} cards in {time.perf_counter() - start:.2f}s, {problem_count} boxes with problems")
+    return problem_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the text on every card fits, by measuring it without rendering anything.")
+    parser.add_argument("classes", nargs="*", help="Classes to check (default: every class)")
+    parser.add_argument("--min-font-size", type=int, default=MIN_FONT_SIZE,
+                        help=f"Flag boxes that had to shrink their text below this size (default: {MIN_FONT_SIZE})")
+    parser.add_argument("--problems-only", "-p", action="store_true", help="Only list boxes with problems")
+    args = parser.parse_args()
+    sys.exit(1 if lint(args.classes or get_class_names(), args.min_font_size, args.problems_only) else 0)
@@ -1,72 +1,479 @@
-import importlib
+import argparse
+import concurrent.futures
 import os.path
 import shutil
+import time
 import tomllib
+import traceback
+from collections import deque
 from glob import glob
+from itertools import chain
 from types import ModuleType
-from typing import Any, List, Tuple, Optional
+from typing import Any, List, Tuple, Optional, Iterable, Iterator, NamedTuple, Union
 
 from PIL import Image
 
-from pil_helpers import save_page
+import instrumentation
+from card_store import CardStore
+from catalog import Catalog, load_catalog, get_class_module
+from encoder_pool import EncoderPool
+from manifest import Manifest
+from pdf_writer import PdfWriter, PDF_ENCODINGS
+from pil_helpers import PageCompositor, font_cache_info, save_fit_cache, text_layer_cache, template_cache, \
+    clear_caches, set_render_scale, get_render_scale, PAPER_SIZES, Palette, apply_palette, save_png, \
+    DEFAULT_PALETTE_COLORS, DEFAULT_PALETTE_MAX_ERROR, PALETTE_ERROR_TILE
 
+# Cards built with a manifest carry the digest of their inputs in Image.info under this key, so that pages can tell
+# whether the cards on them changed
+CARD_DIGEST_KEY = "card_digest"
+# Set on cards loaded from the last build's PNGs. They're closed as soon as they've been added to a page, and only
+# opened again and decoded if the page has to be saved again.
+CARD_REUSED_KEY = "card_reused"
+# How long rendering a card took, for the card store
+CARD_RENDER_SECONDS_KEY = "card_render_seconds"
+# Where iter_cards gets cards that it doesn't render: the last build's PNG, which the manifest says is up to date, the
+# card store, or a card rendered earlier in the same class that draws exactly the same
+CURRENT = "current"
+STORED = "stored"
+DUPLICATE = "duplicate"
+# Pixels come out the same at any level, and this one saves pages about three times faster than the default.
+# Used when speed matters more than file size, when watching or previewing.
+FAST_COMPRESS_LEVEL = 1
+OUTPUT_FOLDER = "output"
+# Previews are saved separately, so that they never replace the print build
+PREVIEW_OUTPUT_FOLDER = os.path.join(OUTPUT_FOLDER, "preview")
+PREVIEW_SCALE = 0.25
+# Cards are drawn at their normal size to fill a grid this many cards to a side
+NORMAL_GRID_SIZE = 3
 
-def main(minimum_level: int = 1):
-    card_list = []
+# Where this build is being saved, OUTPUT_FOLDER or PREVIEW_OUTPUT_FOLDER
+_output_folder = OUTPUT_FOLDER
+
+
+class PageLayout(NamedTuple):
+    """
+    A grid of cards on a size of paper, named in PAPER_SIZES. Layouts with fewer cards to a side get bigger cards.
+    """
+    grid: Tuple[int, int]
+    paper: str = "letter"
+
+    @classmethod
+    def parse(cls, value: str) -> "PageLayout":
+        """
+        Args:
+            value: COLUMNSxROWS, optionally followed by :PAPER. e.g. 3x3, or 2x2:a4
+        """
+        grid, _, paper = value.partition(":")
+        try:
+            columns, rows = (int(n) for n in grid.lower().split("x"))
+        except ValueError:
+            raise ValueError(f"Invalid grid: {grid}. Expected COLUMNSxROWS, e.g. 3x3")
+        if columns < 1 or rows < 1:
+            raise ValueError(f"Invalid grid: {grid}. Expected at least one column and row")
+        paper = paper.lower() or "letter"
+        if paper not in PAPER_SIZES:
+            raise ValueError(f"Invalid paper: {paper}. Expected one of {list(PAPER_SIZES)}")
+        return cls((columns, rows), paper)
+
+    @property
+    def name(self) -> str:
+        return f"{self.grid[0]}x{self.grid[1]}_{self.paper}"
+
+    @property
+    def card_scale(self) -> float:
+        """
+        Size of the cards on this layout, relative to their size on a 3x3 grid. They may be shrunk further to fit the
+        paper.
+        """
+        return NORMAL_GRID_SIZE / max(self.grid)
+
+
+def main(minimum_level: int = 1, jobs: int = 1, incremental: bool = False, page_format: str = "png",
+         pdf_encoding: str = "flate", compress_level: int = 6, quality: int = 90, trace: Optional[str] = None,
+         profile_slowest: int = 0, preview_scale: Optional[float] = None, layouts: Optional[List[PageLayout]] = None,
+         use_card_store: bool = True, palette: Optional[Palette] = None):
+    """
+    Args:
+        incremental: Skip cards and pages whose inputs haven't changed since the last build. Every build records its
+            inputs in the manifest either way.
+        page_format, pdf_encoding, compress_level, quality: See save_cards_to_pages. compress_level is used for the
+            card PNGs as well.
+        trace: If given, time every stage of the build, write the spans to this path as a Chrome trace file, and
+            print a summary.
+        profile_slowest: Once the build is done, render this many of the slowest cards again under cProfile.
+            Turns on tracing to find them.
+        preview_scale: If given, render every card and page at this fraction of their size, e.g. 0.25, and save them
+            under PREVIEW_OUTPUT_FOLDER. For checking layouts quickly.
+        layouts: If given, render each card once, at the size the layout with the biggest cards needs, and lay the
+            deck out on pages of every one of these layouts (see save_cards_to_layouts) instead of the usual 2x2 pages.
+        use_card_store: Reuse cards from the card store rather than rendering them again, and add the cards that do
+            get rendered to it. See CardStore.
+        palette: If given, save card PNGs and PNG pages with an adaptive palette rather than in truecolor. They're
+            several times smaller and quicker to encode. Any image the palette would change too much is saved in
+            truecolor anyway.
+    """
+    global _output_folder
+    if trace or profile_slowest:
+        instrumentation.enable()
+    set_render_scale(preview_scale or 1.0)
+    _output_folder = PREVIEW_OUTPUT_FOLDER if preview_scale else OUTPUT_FOLDER
+    page_options = dict(page_format=page_format, pdf_encoding=pdf_encoding, compress_level=compress_level,
+                        quality=quality, palette=palette)
+    manifest = Manifest(os.path.join(_output_folder, "manifest.json"), reuse=incremental)
+    catalog = Catalog()
+    card_store = CardStore() if use_card_store else None
+    # Cards are rendered as the pages ask for them, so only one page's worth of cards is ever in memory
     # Normal-sized cards
-    # card_list = build_cards("fighter", include_cards=[
+    # cards = iter_cards("fighter", include_cards=[
     #     "monster_hunter_protection_from_evil_and_good",
     # ])
-    # card_list += build_cards("fighter", minimum_level=minimum_level)
-    # card_list += build_cards("onednd_fighter", minimum_level=minimum_level)
-    # card_list += build_cards("ranger", minimum_level=minimum_level)
-    # card_list += build_cards("wizard", minimum_level=minimum_level)
-    # save_cards_to_pages(card_list)
+    # cards = chain(
+    #     iter_cards("fighter", minimum_level=minimum_level),
+    #     iter_cards("onednd_fighter", minimum_level=minimum_level),
+    #     iter_cards("ranger", minimum_level=minimum_level),
+    #     iter_cards("wizard", minimum_level=minimum_level),
+    # )
+    # save_cards_to_pages(cards, **page_options)
     # Large rogue pages
-    card_list += build_cards("common")
-    card_list += build_cards("onednd_rogue", minimum_level=minimum_level)
-    save_cards_to_pages(card_list, (2, 2), "rogue_pages")
+    # Cards and pages are compressed and written in the background while the next ones are rendered
+    with EncoderPool() as encoder:
+        card_scale = max(layout.card_scale for layout in layouts) if layouts else None
+        cards = chain(
+            iter_cards("common", jobs=jobs, manifest=manifest, compress_level=compress_level, catalog=catalog,
+                       encoder=encoder, scale=get_class_card_scale("common", card_scale), card_store=card_store,
+                       palette=palette),
+            iter_cards("onednd_rogue", minimum_level=minimum_level, jobs=jobs, manifest=manifest,
+                       compress_level=compress_level, catalog=catalog, encoder=encoder,
+                       scale=get_class_card_scale("onednd_rogue", card_scale), card_store=card_store,
+                       palette=palette),
+        )
+        if layouts:
+            save_cards_to_layouts(cards, layouts, "rogue_pages", card_scale, manifest=manifest, encoder=encoder,
+                                  **page_options)
+        else:
+            save_cards_to_pages(cards, (2, 2), "rogue_pages", manifest=manifest, encoder=encoder, **page_options)
+    manifest.save()
+    if card_store is not None:
+        card_store.save()
+        card_store.print_session_summary()
+    if trace:
+        instrumentation.write_trace(trace)
+        print(f"Wrote trace to {trace}")
+        instrumentation.print_summary()
+    if profile_slowest:
+        profile_slowest_cards(profile_slowest, minimum_level)
+    if jobs <= 1:
+        # Worker processes keep their own caches, so these numbers only mean something for serial builds
+        print(f"Font cache: {font_cache_info()}")
+        print(f"Text layer cache: {text_layer_cache.cache_info()}")
+        print(f"Template cache: {template_cache.cache_info()}")
+
+
+def watch_and_build(polling: bool = False, **build_options):
+    """
+    Builds everything, then waits for ability TOMLs and templates to change and builds again. Each rebuild runs
+    incrementally in this same process, so fonts, templates and class modules are already loaded and only the
+    edited cards and the pages they're on are rendered.
+
+    Args:
+        polling: Poll for changes even where inotify is available.
+        build_options: Passed on to main. compress_level defaults to FAST_COMPRESS_LEVEL, since zlib takes up most
+            of a rebuild at the usual level.
+    """
+    # Only imported when watching, like the other modules that ordinary builds and worker processes don't need
+    from watch import make_watcher, iter_changes
+
+    build_options["incremental"] = True
+    if build_options.get("compress_level") is None:
+        build_options["compress_level"] = FAST_COMPRESS_LEVEL
+    main(**build_options)
+    watcher = make_watcher(polling=polling)
+    print(f"\nWatching for changes with {type(watcher).__name__} (Ctrl+C to stop)")
+    try:
+        for changed in iter_changes(watcher):
+            print(f"\nChanged: {', '.join(sorted(changed))}")
+            start = time.perf_counter()
+            try:
+                main(**build_options)
+            except Exception:
+                # A half-written TOML shouldn't stop the watch, the next save will fix it
+                traceback.print_exc()
+                continue
+            print(f"Rebuilt in {time.perf_counter() - start:.2f}s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def get_class_card_scale(class_name: str, card_scale: Optional[float]) -> float:
+    """
+    @return float: The scale to render the class's cards at, for them to come out card_scale times their size on a
+        3x3 grid. 1.0, the size the class module draws them at, if card_scale is None.
+    """
+    if card_scale is None:
+        return 1.0
+    # Some class modules draw their cards bigger than normal, for 2x2 pages
+    return card_scale / get_class_module(class_name).LAYOUT.scale
+
+
+def build_cards(class_name: str, minimum_level: int = 1, include_cards: List[str] = None, jobs: int = 1,
+                manifest: Optional[Manifest] = None, catalog: Optional[Catalog] = None) -> List[Image]:
+    """
+    Builds every card at once. See iter_cards.
+    """
+    return list(iter_cards(class_name, minimum_level, include_cards, jobs, manifest, catalog=catalog))
 
 
-def build_cards(class_name: str, minimum_level: int = 1, include_cards: List[str] = None) -> List[Image]:
+def iter_cards(class_name: str, minimum_level: int = 1, include_cards: List[str] = None, jobs: int = 1,
+               manifest: Optional[Manifest] = None, compress_level: int = 6, catalog: Optional[Catalog] = None,
+               encoder: Optional[EncoderPool] = None, scale: float = 1.0, card_store: Optional[CardStore] = None,
+               palette: Optional[Palette] = None) -> Iterator[Image]:
     """
+    Renders and saves the cards of a class, yielding each one as it's ready.
+
     Args:
         class_name:
         minimum_level:
         include_cards: If defined, only cards with filenames matching this value will be built.
             Does not include the file extension. e.g. superiority_dice
+        jobs: Number of worker processes to render cards with. 1 renders everything in this process.
+            Cards are always yielded in filename order, so pages come out the same either way. Only a couple of
+            cards per worker are rendered ahead of the card being yielded.
+        manifest: If given, cards the manifest says are up to date are loaded from their saved PNGs instead of being
+            rendered again, and everything that does get rendered is recorded in it.
+        compress_level: zlib compression level (0-9) for the saved card PNGs.
+        catalog: Used to pick out the cards to build without parsing every TOML. Loaded if not given. Only this
+            class is brought up to date in it.
+        encoder: If given, cards rendered in this process are saved through it in the background. Cards rendered by
+            worker processes are saved by the workers.
+        scale: Render the cards at this multiple of the size their class module draws them at.
+        card_store: If given, cards it already has are linked into the output folder instead of being rendered, as
+            are cards that draw the same as one rendered earlier, and everything that does get rendered is added to
+            it once saved. CardStore.save has to be called after the cards have all been written.
+        palette: If given, cards are saved as palette PNGs, and yielded as the palette image that was saved.
     """
+    if catalog is None:
+        catalog = load_catalog([class_name])
+    else:
+        catalog.update([class_name])
+        catalog.save()
+    toml_paths = catalog.select([class_name], minimum_level=minimum_level, filenames=include_cards)
+    os.makedirs(os.path.join(_output_folder, "cards", class_name), exist_ok=True)
     # Load the class module
-    class_module = importlib.import_module(f"classes.{class_name}.src")
-    # Build the cards defined by the given toml dicts
-    images = []
-    for toml_path in glob(f"classes/{class_name}/abilities/*.toml"):
-        filename = os.path.basename(toml_path).replace(".toml", "")
-        if include_cards and filename not in include_cards:
-            continue
-        im = build_card(class_module, toml_path, minimum_level=minimum_level)
+    class_module = get_class_module(class_name)
+
+    def finish_card(toml_path: str, im: Optional[Union[Image, str]], source: Optional[str]) -> Optional[Image]:
+        reused = source == CURRENT
+        if source in (CURRENT, STORED) and im is not None:
+            # Only opened now, rather than while working out what to render, so that the deck's saved cards don't
+            # all hold their PNGs open at once. Opening is lazy, so the PNG only gets decoded if a page with this card
+            # on it needs saving.
+            im = Image.open(im)
+        if source == DUPLICATE:
+            # A copy, so this card's digest doesn't end up on the one it duplicates
+            im = rendered_duplicates[keys[toml_path]].copy()
+            card_store.add_duplicate(keys[toml_path], get_card_output_path(class_name, toml_path))
+        elif source is None and card_store is not None and im is not None:
+            card_store.add(keys[toml_path], get_card_output_path(class_name, toml_path),
+                           im.info.pop(CARD_RENDER_SECONDS_KEY))
+            if keys[toml_path] in duplicated_keys:
+                rendered_duplicates[keys[toml_path]] = im
+        if manifest is not None:
+            if not reused:
+                output_path = get_card_output_path(class_name, toml_path) if im is not None else None
+                manifest.set_card(toml_path, digests[toml_path], output_path)
+            if im is not None:
+                im.info[CARD_DIGEST_KEY] = digests[toml_path]
+                im.info[CARD_REUSED_KEY] = reused
+        return im
+
+    # Work out which cards don't need rendering. Each entry is the TOML path, where the card comes from (see
+    # CURRENT, STORED and DUPLICATE, or None if it has to be rendered) and, for cards that are already saved, their PNG,
+    # which finish_card opens (or None if the card is skipped)
+    digests = {}
+    keys = {}
+    # Fields of the cards the card store had to read, so that rendering them doesn't parse the TOML again
+    toml_dicts = {}
+    keys_to_render = set()
+    duplicated_keys = set()
+    rendered_duplicates = {}
+    cards_to_build = []
+    for toml_path in toml_paths:
+        if manifest is not None:
+            digests[toml_path] = manifest.get_card_digest(class_name, class_module, toml_path, minimum_level, scale,
+                                                          palette)
+            is_current, output_path = manifest.get_current_card(toml_path, digests[toml_path])
+            if is_current:
+                cards_to_build.append((toml_path, CURRENT, output_path))
+                continue
+        if card_store is not None:
+            toml_dicts[toml_path] = open_toml(toml_path)
+            key = keys[toml_path] = card_store.get_key(class_name, class_module, toml_dicts[toml_path], scale,
+                                                       palette)
+            output_path = get_card_output_path(class_name, toml_path)
+            if card_store.get(key, output_path):
+                cards_to_build.append((toml_path, STORED, output_path))
+                continue
+            if key in keys_to_render:
+                duplicated_keys.add(key)
+                cards_to_build.append((toml_path, DUPLICATE, None))
+                continue
+            keys_to_render.add(key)
+        cards_to_build.append((toml_path, None, None))
+
+    if jobs > 1 and sum(1 for _, source, _ in cards_to_build if source is None) > 1:
+        # Each worker imports the class module once, then renders and saves the cards it's handed.
+        # Keep a bounded number of cards in flight, and hand them out in order.
+        # concurrent.futures only imports the process pool, and multiprocessing with it, once it's used
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_init_worker,
+                initargs=(class_name, instrumentation.get_tracer() is not None, get_render_scale(), _output_folder),
+        ) as executor:
+            in_flight = deque()
+            for toml_path, source, im in cards_to_build:
+                if source is None:
+                    im = executor.submit(_build_and_save_card_in_worker, toml_path, minimum_level, compress_level,
+                                         scale, palette, toml_dicts.get(toml_path))
+                in_flight.append((toml_path, source, im))
+                while in_flight and (in_flight[0][1] is not None or len(in_flight) > jobs * 2):
+                    toml_path, source, im = in_flight.popleft()
+                    im = finish_card(toml_path, im if source is not None else _get_worker_result(im), source)
+                    if im is not None:
+                        yield im
+            while in_flight:
+                toml_path, source, im = in_flight.popleft()
+                im = finish_card(toml_path, im if source is not None else _get_worker_result(im), source)
+                if im is not None:
+                    yield im
+    else:
+        for toml_path, source, im in cards_to_build:
+            if source is None:
+                im = build_and_save_card(class_module, class_name, toml_path, minimum_level=minimum_level,
+                                         compress_level=compress_level, encoder=encoder, scale=scale,
+                                         palette=palette, toml_dict=toml_dicts.get(toml_path))
+            im = finish_card(toml_path, im, source)
+            if im is not None:
+                yield im
+        save_fit_cache()
+
+
+def get_card_output_path(class_name: str, toml_path: str) -> str:
+    filename = os.path.basename(toml_path).replace(".toml", "")
+    return f"{_output_folder}/cards/{class_name}/{filename}.png"
+
+
+_worker_class_name: Optional[str] = None
+_worker_class_module: Optional[ModuleType] = None
+
+
+def _init_worker(class_name: str, trace: bool, render_scale: float, output_folder: str):
+    global _worker_class_name, _worker_class_module, _output_folder
+    _worker_class_name = class_name
+    _worker_class_module = get_class_module(class_name)
+    set_render_scale(render_scale)
+    _output_folder = output_folder
+    # Forked workers start with a copy of the main process's tracer, whose spans it already has
+    instrumentation.disable()
+    if trace:
+        instrumentation.enable()
+
+
+def _build_and_save_card_in_worker(toml_path: str, minimum_level: int, compress_level: int, scale: float,
+                                   palette: Optional[Palette], toml_dict: Optional[dict[str, Any]]
+                                   ) -> Tuple[Optional[Image], Optional[tuple]]:
+    im = build_and_save_card(_worker_class_module, _worker_class_name, toml_path, minimum_level=minimum_level,
+                             compress_level=compress_level, scale=scale, palette=palette, toml_dict=toml_dict)
+    # Workers don't get a chance to clean up when the pool shuts down, so share new font fits right away
+    save_fit_cache()
+    tracer = instrumentation.get_tracer()
+    return im, tracer.drain() if tracer is not None else None
+
+
+def _get_worker_result(future: concurrent.futures.Future) -> Optional[Image]:
+    im, trace = future.result()
+    if trace is not None:
+        instrumentation.get_tracer().merge(*trace)
+    return im
+
+
+def build_and_save_card(class_module: ModuleType, class_name: str, toml_path: str, minimum_level: int = 1,
+                        compress_level: int = 6, encoder: Optional[EncoderPool] = None, scale: float = 1.0,
+                        palette: Optional[Palette] = None, toml_dict: Optional[dict[str, Any]] = None
+                        ) -> Optional[Image]:
+    """
+    Renders the card from toml_path and saves it to its output PNG.
+
+    Args:
+        toml_dict: The card's fields, if toml_path has already been read. Read from toml_path if not given.
+    """
+    card_name = os.path.basename(toml_path).replace(".toml", "")
+    with instrumentation.card_span(f"{class_name}/{card_name}", class_name=class_name, toml_path=toml_path,
+                                   scale=scale):
+        start = time.perf_counter()
+        if toml_dict is None:
+            toml_dict = open_toml(toml_path)
+        im = build_card_from_dict(class_module, toml_dict, minimum_level, scale)
         if im is None:
-            continue
-        # Save image file
-        os.makedirs(f"output/cards/{class_name}", exist_ok=True)
-        im.save(f"output/cards/{class_name}/{filename}.png")
-        images.append(im)
-    return images
+            return None
+        render_seconds = time.perf_counter() - start
+        # Save image file. The old one may be linked into the card store, so it's replaced rather than written over.
+        output_path = get_card_output_path(class_name, toml_path)
+        if os.path.lexists(output_path):
+            os.remove(output_path)
+        with instrumentation.span("save_card"):
+            # Quantized here rather than by the encoder, so that pages get the same pixels from a card whether it was
+            # just rendered or is reused from its PNG
+            im = apply_palette(im, palette, output_path)
+            im.info[CARD_RENDER_SECONDS_KEY] = render_seconds
+            if encoder is None:
+                im.save(output_path, compress_level=compress_level)
+            else:
+                encoder.save(im, output_path, compress_level=compress_level)
+        return im
+
 
+def profile_slowest_cards(n: int, minimum_level: int = 1, folder: str = "output/profiles"):
+    """
+    Renders the n slowest cards of the traced build again, from cold caches, under cProfile. Each profile is saved
+    to folder, and the top of each is printed.
+    """
+    import cProfile
+    import pstats
+
+    os.makedirs(folder, exist_ok=True)
+    for card in instrumentation.get_slowest_cards(n):
+        class_module = get_class_module(card["class_name"])
+        clear_caches()
+        profile = cProfile.Profile()
+        profile.runcall(build_card, class_module, card["toml_path"], minimum_level=minimum_level, scale=card["scale"])
+        profile_path = os.path.join(folder, card["name"].replace("/", "__") + ".prof")
+        profile.dump_stats(profile_path)
+        print(f"\nProfile of {card['name']} ({card['dur'] / 1000:.1f} ms during the build), saved to {profile_path}")
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(15)
 
-def build_card(class_module: ModuleType, toml_path: str, minimum_level: int = 1) -> Optional[Image]:
+
+def build_card(class_module: ModuleType, toml_path: str, minimum_level: int = 1, scale: float = 1.0
+               ) -> Optional[Image]:
     # Load the given toml dict
-    toml_dict = open_toml(toml_path)
+    return build_card_from_dict(class_module, open_toml(toml_path), minimum_level, scale)
+
+
+def build_card_from_dict(class_module: ModuleType, toml_dict: dict[str, Any], minimum_level: int = 1,
+                         scale: float = 1.0) -> Optional[Image]:
+    """
+    Renders a card from its fields, as read from an ability TOML, at scale times the size its class module draws it.
+
+    @return Image: The card, or None if it's skipped or below minimum_level.
+    """
     if toml_dict.get("skip"):
         return None
     if toml_dict.get("level"):
         if int(toml_dict["level"]) < minimum_level:
             return None
     print(toml_dict["name"])
-    # Call class module code
-    im = class_module.get_template(toml_dict)
-    class_module.add_text(im, toml_dict)
-    return im
+    # Draw it the way the class module's layout plan says
+    return class_module.LAYOUT.compile(scale).render(toml_dict)
 
 
 def open_toml(filepath: str) -> dict[str, Any]:
@@ -74,20 +481,222 @@ def open_toml(filepath: str) -> dict[str, Any]:
         return tomllib.load(f)
 
 
-def gen_chunks(chunk_list, n):
-    for i in range(0, len(chunk_list), n):
-        yield chunk_list[i:i + n]
+class PageSaver:
+    """
+    Lays cards out on pages of one layout as they're added, saving each page as soon as it's full. See
+    save_cards_to_pages for the arguments.
+    """
+
+    def __init__(self, grid: Tuple[int, int], folder: str, manifest: Optional[Manifest] = None,
+                 page_format: str = "png", pdf_encoding: str = "flate", compress_level: int = 6, quality: int = 90,
+                 encoder: Optional[EncoderPool] = None, paper: str = "letter", card_scale: float = 1.0,
+                 palette: Optional[Palette] = None):
+        if page_format not in ("png", "pdf"):
+            raise ValueError(f"Invalid page format: {page_format}")
+        if pdf_encoding not in PDF_ENCODINGS:
+            raise ValueError(f"Invalid PDF encoding: {pdf_encoding}")
+        self.grid, self.manifest, self.encoder = grid, manifest, encoder
+        self.pdf_encoding, self.compress_level, self.quality = pdf_encoding, compress_level, quality
+        self.paper, self.card_scale, self.palette = paper, card_scale, palette
+        # Pages are laid out at 300 dpi, or proportionally less for previews
+        render_scale = get_render_scale()
+        self.cut_line_width = max(1, round(10 * render_scale))
+        self.dpi = round(300 * render_scale)
+        self.folder_path = f"{_output_folder}/{folder}"
+        self.pdf_writer = None
+        if page_format == "pdf":
+            os.makedirs(_output_folder, exist_ok=True)
+            self.pdf_writer = PdfWriter(f"{self.folder_path}.pdf")
+        elif manifest is None or not manifest.reuse:
+            shutil.rmtree(self.folder_path, ignore_errors=True)
+        if self.pdf_writer is None:
+            os.makedirs(self.folder_path, exist_ok=True)
+        self.compositor = PageCompositor(grid, self.cut_line_width, self.dpi, PAPER_SIZES[paper], card_scale)
+        self.filenames = []
+        self.card_digests = []
+        # Slots and PNGs of cards reused from the last build, pasted once it's clear that the page has changed
+        self.unpasted_cards = []
 
+    def add_card(self, card: Image):
+        slot = len(self.card_digests)
+        self.card_digests.append(card.info.get(CARD_DIGEST_KEY))
+        if card.info.get(CARD_REUSED_KEY):
+            # Closed right away, and opened again only if the page turns out to need saving, so that pages which
+            # haven't changed don't leave their cards' PNGs open. Other layouts only need the card's info and filename.
+            self.unpasted_cards.append((slot, card.filename))
+            card.close()
+        else:
+            # A freshly rendered card always means the page has changed
+            self.compositor.add_card(card, slot)
+        if len(self.card_digests) == self.compositor.slot_count:
+            self.finish_page()
 
-def save_cards_to_pages(card_list: List[Image], grid: Tuple[int, int] = (3, 3), folder: str = "pages"):
-    folder_path = f"output/{folder}"
-    shutil.rmtree(folder_path, ignore_errors=True)
-    os.makedirs(folder_path, exist_ok=True)
-    for i, chunk in enumerate(gen_chunks(card_list, grid[0] * grid[1])):
-        filename = f"output/{folder}/{i + 1:>03}.png"
+    def finish_page(self):
+        filename = f"{self.folder_path}/{len(self.filenames) + 1:>03}.png"
+        self.filenames.append(filename)
+        digest = None
+        if self.manifest is not None and self.pdf_writer is None:
+            digest = self.manifest.get_page_digest(self.card_digests, self.grid, self.cut_line_width, self.dpi,
+                                                   self.paper, self.card_scale, self.palette)
+            if self.compositor.page is None and self.manifest.is_page_current(filename, digest):
+                print(f"Skipping {filename}, its cards haven't changed")
+                self.unpasted_cards.clear()
+                self.card_digests.clear()
+                return
+        for slot, card_path in self.unpasted_cards:
+            with Image.open(card_path) as unpasted_card:
+                self.compositor.add_card(unpasted_card, slot)
+        self.unpasted_cards.clear()
+        self.card_digests.clear()
+        if self.pdf_writer is not None:
+            print(f"Adding page {len(self.filenames)} to {self.pdf_writer.filename}")
+            with instrumentation.span("save_page", page=filename):
+                self.pdf_writer.add_page(self.compositor.finish_page(), dpi=self.dpi, encoding=self.pdf_encoding,
+                                         compress_level=self.compress_level, quality=self.quality)
+            return
         print(f"Saving {filename}")
-        save_page(chunk, grid, filename, cut_line_width=10)
+        with instrumentation.span("save_page", page=filename):
+            if self.encoder is None:
+                save_png(self.compositor.finish_page(), filename, self.palette, dpi=(self.dpi, self.dpi),
+                         compress_level=self.compress_level)
+            else:
+                self.encoder.save(self.compositor.finish_page(), filename, palette=self.palette,
+                                  dpi=(self.dpi, self.dpi), compress_level=self.compress_level)
+        if self.manifest is not None:
+            self.manifest.set_page(filename, digest)
+
+    def finish(self):
+        """
+        Saves the last page, if it isn't full, and clears out pages left over from when the deck was bigger.
+        """
+        if self.card_digests:
+            self.finish_page()
+        if self.manifest is not None and self.pdf_writer is None:
+            for filename in glob(f"{self.folder_path}/*.png"):
+                if filename not in self.filenames:
+                    os.remove(filename)
+                    self.manifest.remove_page(filename)
+
+    def close(self):
+        if self.pdf_writer is not None:
+            self.pdf_writer.close()
+
+
+def save_cards_to_pages(cards: Iterable[Image], grid: Tuple[int, int] = (3, 3), folder: str = "pages",
+                        manifest: Optional[Manifest] = None, page_format: str = "png", pdf_encoding: str = "flate",
+                        compress_level: int = 6, quality: int = 90, encoder: Optional[EncoderPool] = None,
+                        palette: Optional[Palette] = None):
+    """
+    Lays cards out on pages as they arrive, saving each page as soon as it's full.
+
+    Args:
+        manifest: If given, pages holding exactly the same cards as last time are left alone rather than being
+            rewritten, and pages beyond the end of the deck are removed. Only applies to PNG pages.
+        page_format: "png" to save each page to {output folder}/{folder}/, or "pdf" to write every page into a
+            single {output folder}/{folder}.pdf as it's finished.
+        pdf_encoding: How pages are stored in the PDF. "flate" is lossless, "jpeg" is smaller and quicker to encode.
+        compress_level: zlib compression level (0-9) for PNG pages and flate-encoded PDF pages.
+        quality: JPEG quality for jpeg-encoded PDF pages.
+        encoder: If given, PNG pages are saved through it in the background. PDF pages are always written in order
+            as they're finished.
+        palette: If given, PNG pages are saved with an adaptive palette (see pil_helpers.apply_palette). PDF pages
+            are stored in truecolor either way.
+    """
+    _save_pages(cards, [PageSaver(grid, folder, manifest, page_format, pdf_encoding, compress_level, quality,
+                                  encoder, palette=palette)])
+
+
+def save_cards_to_layouts(cards: Iterable[Image], layouts: Iterable[PageLayout], folder: str = "pages",
+                          card_scale: float = 1.0, **page_options):
+    """
+    Lays the same cards out on pages of every layout in a single pass, so each card only has to be rendered once.
+    Cards are resized to suit each layout as they're pasted. Pages of each layout go to {folder}_{layout name}.
+
+    Args:
+        card_scale: Size the cards were rendered at, relative to their size on a 3x3 grid.
+        page_options: See save_cards_to_pages.
+    """
+    savers = []
+    try:
+        for layout in layouts:
+            savers.append(PageSaver(layout.grid, f"{folder}_{layout.name}", paper=layout.paper,
+                                    card_scale=layout.card_scale / card_scale, **page_options))
+    except BaseException:
+        for saver in savers:
+            saver.close()
+        raise
+    _save_pages(cards, savers)
+
+
+def _save_pages(cards: Iterable[Image], savers: List[PageSaver]):
+    try:
+        for card in cards:
+            for saver in savers:
+                saver.add_card(card)
+            # Cards opened from the last build's PNGs or the card store aren't needed once every layout has them
+            if getattr(card, "filename", None):
+                card.close()
+        for saver in savers:
+            saver.finish()
+    finally:
+        for saver in savers:
+            saver.close()
 
 
 if __name__ == "__main__":
-    main(minimum_level=1)
+    parser = argparse.ArgumentParser(description="Build ability cards and lay them out onto printable pages.")
+    parser.add_argument("--minimum-level", type=int, default=1, help="Skip cards below this level")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of worker processes used to render cards (default: 1, no pool)")
+    parser.add_argument("--incremental", "-i", action="store_true",
+                        help="Only rebuild cards and pages whose inputs changed since the last build")
+    parser.add_argument("--pdf", action="store_const", const="pdf", default="png", dest="page_format",
+                        help="Write pages into one multi-page PDF instead of a PNG per page")
+    parser.add_argument("--pdf-encoding", choices=PDF_ENCODINGS, default="flate",
+                        help="How page images are stored in the PDF (default: flate, which is lossless)")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9",
+                        help="zlib compression level for card PNGs, PNG pages and flate-encoded PDF pages "
+                             f"(default: 6, or {FAST_COMPRESS_LEVEL} with --watch or --preview)")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG quality for jpeg-encoded PDF pages")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="Time each stage of the build, write a per-card Chrome trace file and print a summary")
+    parser.add_argument("--profile-slowest", type=int, default=0, metavar="N",
+                        help="Re-render the N slowest cards under cProfile after the build")
+    parser.add_argument("--watch", "-w", action="store_true",
+                        help="Keep running, and rebuild the cards and pages affected whenever a TOML or template "
+                             "changes. Implies --incremental")
+    parser.add_argument("--poll", action="store_true", help="With --watch, poll for changes instead of using inotify")
+    parser.add_argument("--layout", dest="layouts", action="append", type=PageLayout.parse, metavar="GRID[:PAPER]",
+                        help="Lay the deck out on pages of this grid and paper, e.g. 3x3 or 2x2:a4, rendering each "
+                             "card only once however many layouts there are. Can be given more than once. Paper is "
+                             f"one of {', '.join(PAPER_SIZES)} (default: letter)")
+    parser.add_argument("--palette", type=int, nargs="?", const=DEFAULT_PALETTE_COLORS, metavar="COLORS",
+                        help="Save card PNGs and PNG pages with an adaptive palette of up to COLORS colors (default: "
+                             f"{DEFAULT_PALETTE_COLORS}), which makes them smaller and quicker to write")
+    parser.add_argument("--palette-max-error", type=float, default=DEFAULT_PALETTE_MAX_ERROR, metavar="RMS",
+                        help="With --palette, save images in truecolor anyway if the palette would change them by "
+                             f"more than this in any {PALETTE_ERROR_TILE} pixel square, as the RMS difference of the "
+                             f"worst channel in 0-255 (default: {DEFAULT_PALETTE_MAX_ERROR})")
+    parser.add_argument("--no-card-store", action="store_false", dest="use_card_store",
+                        help="Render every card that isn't up to date, even if an identical one was rendered before")
+    parser.add_argument("--preview", type=float, nargs="?", const=PREVIEW_SCALE, metavar="SCALE",
+                        help=f"Quickly render low resolution cards and pages, at SCALE times their size (default: "
+                             f"{PREVIEW_SCALE}), into {PREVIEW_OUTPUT_FOLDER}")
+    args = parser.parse_args()
+    if args.palette is not None and not 2 <= args.palette <= 256:
+        parser.error(f"argument --palette: {args.palette} colors, expected 2-256")
+    if args.preview is not None and not 0 < args.preview <= 1:
+        parser.error(f"argument --preview: scale {args.preview}, expected more than 0 and at most 1")
+    build_options = dict(minimum_level=args.minimum_level, jobs=args.jobs, incremental=args.incremental,
+                         page_format=args.page_format, pdf_encoding=args.pdf_encoding,
+                         compress_level=args.compress_level, quality=args.quality, preview_scale=args.preview,
+                         layouts=args.layouts, use_card_store=args.use_card_store,
+                         palette=Palette(args.palette, args.palette_max_error) if args.palette else None)
+    if args.preview and build_options["compress_level"] is None:
+        build_options["compress_level"] = FAST_COMPRESS_LEVEL
+    if args.watch:
+        watch_and_build(polling=args.poll, **build_options)
+    else:
+        if build_options["compress_level"] is None:
+            build_options["compress_level"] = 6
+        main(trace=args.trace, profile_slowest=args.profile_slowest, **build_options)
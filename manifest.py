@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import tempfile
+from glob import glob
+from types import ModuleType
+from typing import List, Optional, Iterable, Tuple
+
+from pil_helpers import get_file_signature, get_render_scale, Palette
+
+MANIFEST_PATH = os.path.join("output", "manifest.json")
+
+_file_digests = {}
+
+
+def hash_file(path: str) -> str:
+    """
+    sha1 of the file's contents. Files are only read again if their size or mtime changed.
+    """
+    signature = get_file_signature(path)
+    cached = _file_digests.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, "rb") as f:
+            cached = signature, hashlib.sha1(f.read()).hexdigest()
+        _file_digests[path] = cached
+    return cached[1]
+
+
+def hash_values(values: Iterable) -> str:
+    return hashlib.sha1(json.dumps(list(values)).encode("utf-8")).hexdigest()
+
+
+def get_class_input_paths(class_name: str, class_module: ModuleType) -> List[str]:
+    """
+    Every file, apart from the ability TOMLs, that can change how a card of this class looks: the class module and
+    the layout code it uses, the templates and class icon, and the fonts of every TextBox in its layout plan.
+    """
+    paths = [class_module.__file__, "pil_helpers.py", "enums.py"]
+    paths += sorted(glob("templates/*.png"))
+    paths += sorted(glob(f"classes/{class_name}/templates/*.png"))
+    paths += glob(f"classes/{class_name}/symbol.jpeg")
+    paths += sorted({box.font_name for box in class_module.LAYOUT.boxes})
+    return paths
+
+
+class Manifest:
+    """
+    Remembers what went into every card and page written to the output folder, so an incremental build can skip
+    the ones whose inputs haven't changed.
+
+    Cards are recorded by TOML path, along with the digest of all of their inputs and the PNG they were saved to
+    (None if the card was skipped). Pages are recorded by filename, along with a digest of the cards on them.
+    """
+
+    def __init__(self, path: str = MANIFEST_PATH, reuse: bool = True):
+        """
+        Args:
+            reuse: If False, nothing is considered up to date, but everything built is still recorded so that the
+                next incremental build can use it.
+        """
+        self.path, self.reuse = path, reuse
+        self._class_digests = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.cards = data.get("cards", {})
+        self.pages = data.get("pages", {})
+
+    def get_card_digest(self, class_name: str, class_module: ModuleType, toml_path: str, minimum_level: int,
+                        scale: float = 1.0, palette: Optional[Palette] = None) -> str:
+        if class_name not in self._class_digests:
+            paths = get_class_input_paths(class_name, class_module)
+            self._class_digests[class_name] = hash_values([class_name] + [hash_file(p) for p in paths])
+        return hash_values([self._class_digests[class_name], hash_file(toml_path), minimum_level, scale,
+                            get_render_scale(), palette])
+
+    def get_current_card(self, toml_path: str, digest: str) -> Tuple[bool, Optional[str]]:
+        """
+        @return (bool, str): Whether the card built from toml_path is up to date, and if so, the PNG it was saved to,
+            or None if the card is skipped.
+        """
+        entry = self.cards.get(toml_path)
+        if not self.reuse or entry is None or entry["digest"] != digest:
+            return False, None
+        output_path = entry["output"]
+        if output_path is not None and not os.path.isfile(output_path):
+            return False, None
+        return True, output_path
+
+    def set_card(self, toml_path: str, digest: str, output_path: Optional[str]):
+        self.cards[toml_path] = {"digest": digest, "output": output_path}
+
+    @staticmethod
+    def get_page_digest(card_digests: List[Optional[str]], *settings) -> Optional[str]:
+        """
+        @return str: Digest of a page built from cards with these digests, or None if any card's digest is unknown.
+        """
+        if None in card_digests:
+            return None
+        return hash_values(list(settings) + card_digests)
+
+    def is_page_current(self, filename: str, digest: Optional[str]) -> bool:
+        return (self.reuse and digest is not None and self.pages.get(filename) == digest
+                and os.path.isfile(filename))
+
+    def set_page(self, filename: str, digest: Optional[str]):
+        if digest is None:
+            self.pages.pop(filename, None)
+        else:
+            self.pages[filename] = digest
+
+    def remove_page(self, filename: str):
+        self.pages.pop(filename, None)
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        os.makedirs(folder, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"cards": self.cards, "pages": self.pages}, f, indent=2)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,117 @@
+import io
+import zlib
+from typing import Optional, Union, BinaryIO
+
+from PIL import Image
+
+
+PDF_ENCODINGS = ("flate", "jpeg")
+
+
+class PdfWriter:
+    """
+    Writes a multi-page PDF one page image at a time. Each page is encoded and written out as soon as it's added,
+    so earlier pages don't need to stay in memory the way they do with Pillow's save_all.
+
+    Each page is a single image filling the page, encoded either losslessly with zlib ("flate") or as a JPEG
+    ("jpeg"), which can be picked per page along with the compression level or quality.
+    """
+
+    def __init__(self, file: Union[str, BinaryIO]):
+        """
+        Args:
+            file: Filename to write to, or a binary file object. File objects are left open by close.
+        """
+        self._owns_file = isinstance(file, str)
+        self.filename = file if self._owns_file else getattr(file, "name", "<stream>")
+        self._file = open(file, "wb") if self._owns_file else file
+        self._closed = False
+        # Offsets in the PDF count from where it starts, which isn't necessarily the start of a file object
+        self._start = self._file.tell()
+        self._offsets = []
+        self._page_ids = []
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        # The page tree can only be written once every page is known, so its object number is reserved up front
+        self._pages_id = self._reserve_object()
+        self._catalog_id = self._write_object(b"<< /Type /Catalog /Pages %d 0 R >>" % self._pages_id)
+
+    def __enter__(self) -> "PdfWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_page(self, image: Image.Image, dpi: int = 300, encoding: str = "flate", compress_level: int = 6,
+                 quality: int = 90):
+        """
+        Args:
+            image: The whole page. The page is sized so that the image prints at the given dpi.
+            encoding: "flate" for lossless zlib compression at compress_level (0-9), or "jpeg" at the given quality.
+        """
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        color_space = b"/DeviceRGB" if image.mode == "RGB" else b"/DeviceGray"
+        width, height = image.size
+        if encoding == "flate":
+            data = zlib.compress(image.tobytes(), compress_level)
+            image_filter = b"/FlateDecode"
+        elif encoding == "jpeg":
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=quality)
+            data = buffer.getvalue()
+            image_filter = b"/DCTDecode"
+        else:
+            raise ValueError(f"Invalid PDF encoding: {encoding}. Expected one of {PDF_ENCODINGS}")
+        image_id = self._write_stream(
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter %s"
+            % (width, height, color_space, image_filter),
+            data,
+        )
+        # Page sizes are in points, 72 to the inch
+        page_width, page_height = width * 72 / dpi, height * 72 / dpi
+        contents_id = self._write_stream(b"<<", b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (page_width, page_height))
+        page_id = self._write_object(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.4f %.4f] /Resources << /XObject << /Im0 %d 0 R >> >> "
+            b"/Contents %d 0 R >>" % (self._pages_id, page_width, page_height, image_id, contents_id)
+        )
+        self._page_ids.append(page_id)
+
+    def close(self):
+        if self._closed:
+            return
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self._page_ids)
+        self._write_object(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._page_ids)),
+                           object_id=self._pages_id)
+        xref_offset = self._file.tell() - self._start
+        self._file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(self._offsets) + 1))
+        for offset in self._offsets:
+            self._file.write(b"%010d 00000 n \n" % offset)
+        self._file.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                         % (len(self._offsets) + 1, self._catalog_id, xref_offset))
+        self._closed = True
+        if self._owns_file:
+            self._file.close()
+
+    @property
+    def page_count(self) -> int:
+        return len(self._page_ids)
+
+    def _reserve_object(self) -> int:
+        self._offsets.append(None)
+        return len(self._offsets)
+
+    def _write_object(self, body: bytes, object_id: Optional[int] = None) -> int:
+        if object_id is None:
+            object_id = self._reserve_object()
+        self._offsets[object_id - 1] = self._file.tell() - self._start
+        self._file.write(b"%d 0 obj\n" % object_id)
+        self._file.write(body)
+        self._file.write(b"\nendobj\n")
+        return object_id
+
+    def _write_stream(self, dictionary_start: bytes, data: bytes) -> int:
+        """
+        Writes a stream object. dictionary_start is the stream dictionary without its closing ">>", which gets the
+        stream's /Length added.
+        """
+        return self._write_object(b"%s /Length %d >>\nstream\n%s\nendstream" % (dictionary_start, len(data), data))
@@ -1,34 +1,472 @@
+import hashlib
+import json
+import math
 import os
-from typing import Tuple, Union, List
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from weakref import WeakKeyDictionary
+from typing import Tuple, Union, List, Optional, NamedTuple
 
-from PIL import ImageFont, ImageDraw, Image, ImageOps
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
+from PIL import ImageFont, ImageDraw, Image, ImageOps, ImageChops, ImageMath
+
+import instrumentation
 from enums import HAlign, VAlign
 
 DEBUG_TEXT_BOX_BORDERS = False
-FONTS_FOLDER = os.environ["FONTS_FOLDER"]  # Usually found at C:\Users\<user>\AppData\Local\Microsoft\Windows\Fonts\
-DEFAULT_FONT = os.path.join(FONTS_FOLDER, "Chalfont_Medium.otf")
-TEXT_FONT = os.path.join(FONTS_FOLDER, "Aktiv_Grotesque.otf")
+# Font filenames without a folder are looked up in the folder named by this environment variable, the first time
+# they're used. Usually C:\Users\<user>\AppData\Local\Microsoft\Windows\Fonts\
+FONTS_FOLDER_VARIABLE = "FONTS_FOLDER"
+DEFAULT_FONT = "Chalfont_Medium.otf"
+TEXT_FONT = "Aktiv_Grotesque.otf"
+# Every (font file, size) pair gets parsed by FreeType once per process and then shared by all the TextBoxes.
+# The fit loop touches a few dozen sizes per font, so this comfortably holds a whole deck.
+FONT_CACHE_SIZE = 256
+# Font sizes picked by shrink_font_until_text_fits are remembered here between runs.
+# Bump FIT_CACHE_VERSION whenever a change to the wrapping or measuring code could change the chosen size.
+FIT_CACHE_PATH = os.path.join(".cache", "fit_cache.json")
+# Held by save_fit_cache while it updates FIT_CACHE_PATH
+FIT_CACHE_LOCK_PATH = FIT_CACHE_PATH + ".lock"
+FIT_CACHE_VERSION = 2
+# Fits kept by save_fit_cache, dropping the ones that have gone unused longest. Fits of text that's since been edited,
+# or from before FIT_CACHE_VERSION was bumped, are never used again, so they're the first to go.
+FIT_CACHE_SIZE = 5000
+# A fit that's used again is only marked as used, which means writing the cache, if it hasn't been for this long
+FIT_CACHE_TOUCH_SECONDS = 24 * 60 * 60
+# Decoded card templates, already scaled and with any class icon pasted on. Templates that needed that work are also
+# saved under TEMPLATE_CACHE_FOLDER, so later runs can skip it.
+TEMPLATE_CACHE_SIZE = 32
+TEMPLATE_CACHE_FOLDER = os.path.join(".cache", "templates")
+# Scales each template is kept on disk at, e.g. for printing and a preview or two. Only the most recently used are
+# kept, and copies built from an older version of the template or class icon are removed (see _prune_template_cache).
+TEMPLATE_CACHE_SCALES = 4
+# Finished text layers for boxes whose text repeats across a deck, like action types, sources and levels
+TEXT_LAYER_CACHE_SIZE = 256
+# How templates are resized when rendering below full size for a preview. Much cheaper than the bicubic resampling
+# used for print, and the difference doesn't show at preview sizes.
+PREVIEW_RESAMPLE = Image.Resampling.BILINEAR
+# Colors in the adaptive palette of palette PNGs (see quantize_image). 256, the most a PNG palette can hold.
+DEFAULT_PALETTE_COLORS = 256
+# save_png saves the original RGB or RGBA image, in truecolor, instead of the palette image when the palette image's
+# worst channel differs from it by more than this in any PALETTE_ERROR_TILE square, as an RMS difference (0-255).
+# Images in other modes are always saved as they are.
+DEFAULT_PALETTE_MAX_ERROR = 5.0
+# Side of the squares the palette error is measured over, in pixels. Measured over the whole image, the plain margins
+# of a page would average away banding in a small patch of card art or text.
+PALETTE_ERROR_TILE = 64
+
+# Every template, text box and page is rendered at this multiple of its normal size. See set_render_scale.
+_render_scale = 1.0
+
+
+def set_render_scale(scale: float):
+    """
+    Renders everything from now on at scale times its normal size, on top of any scale the class modules ask for,
+    e.g. 0.25 for quick low resolution previews. Layouts stay in proportion, since every box position, size and font
+    size is scaled along with the templates.
+    """
+    global _render_scale
+    _render_scale = scale
+
+
+def get_render_scale() -> float:
+    return _render_scale
+
+
+def load_template(filepath: str, scale: float = 1.0, icon_dirname: Optional[str] = None) -> Image.Image:
+    """
+    Returns a copy of the template at filepath, with the class icon for icon_dirname pasted on (see add_class_icon)
+    and then resized by scale (and the render scale). The finished template is kept in template_cache, and on disk if
+    it took any work.
+    """
+    scale *= _render_scale
+    resample = Image.Resampling.BICUBIC if _render_scale == 1.0 else PREVIEW_RESAMPLE
+    icon_path = f"classes/{icon_dirname}/symbol.jpeg" if icon_dirname else None
+    if icon_path and not os.path.isfile(icon_path):
+        icon_path = None
+    with instrumentation.span("load_template"):
+        cache_key = (filepath, get_file_signature(filepath), scale, icon_path,
+                     get_file_signature(icon_path) if icon_path else None, resample)
+        template = template_cache.get(cache_key)
+        if template is None:
+            template = _load_template_from_disk(filepath, scale, icon_dirname, resample, cache_key)
+            template_cache.put(cache_key, template)
+        return template.copy()
+
+
+def _load_template_from_disk(filepath: str, scale: float, icon_dirname: Optional[str], resample: int,
+                             cache_key: tuple) -> Image.Image:
+    _, signature, _, icon_path, icon_signature, _ = cache_key
+    if scale == 1.0 and icon_path is None:
+        # Nothing to do to this template, so the original file is as quick to load as a cached one would be
+        im = Image.open(filepath)
+        im.load()
+        return im
+    # Named for the template and icon, the versions of them it was built from, and the scale it was built at
+    source, inputs, variant = (hashlib.sha1(repr(part).encode("utf-8")).hexdigest()[:16] for part in (
+        (filepath, icon_path), (signature, icon_signature), (scale, resample)))
+    cache_path = os.path.join(TEMPLATE_CACHE_FOLDER, f"{source}_{inputs}_{variant}.png")
+    if os.path.isfile(cache_path):
+        im = Image.open(cache_path)
+        im.load()
+        # Marks it as recently used, for _prune_template_cache
+        os.utime(cache_path)
+        return im
+    im = Image.open(filepath)
+    if icon_dirname:
+        add_class_icon(im, icon_dirname)
+    if scale != 1.0:
+        width, height = im.size
+        # Reducing in integer steps first is a big saving when shrinking a lot for a preview
+        reducing_gap = None if resample == Image.Resampling.BICUBIC else 2.0
+        im = im.resize((int(scale * width), int(scale * height)), resample, reducing_gap=reducing_gap)
+    os.makedirs(TEMPLATE_CACHE_FOLDER, exist_ok=True)
+    # Hidden until it's complete, so _prune_template_cache leaves it alone
+    fd, temp_path = tempfile.mkstemp(dir=TEMPLATE_CACHE_FOLDER, prefix=".", suffix=".png")
+    with os.fdopen(fd, "wb") as f:
+        im.save(f, format="PNG", compress_level=1)
+    os.replace(temp_path, cache_path)
+    _prune_template_cache(source, inputs)
+    return im
+
+
+def _prune_template_cache(source: str, inputs: str):
+    """
+    Removes the template's cached copies that were built from older versions of it or its class icon, and all but the
+    TEMPLATE_CACHE_SCALES most recently used scales of it. Also removes copies cached under the old naming, which
+    only changed when the whole cache key did.
+
+    Args:
+        source, inputs: The first two parts of the template's cache filenames. See _load_template_from_disk.
+    """
+    current = []
+    for filename in os.listdir(TEMPLATE_CACHE_FOLDER):
+        path = os.path.join(TEMPLATE_CACHE_FOLDER, filename)
+        parts = filename.removesuffix(".png").split("_")
+        if filename.startswith(".") or (len(parts) == 3 and parts[0] != source):
+            continue
+        # Worker processes may be pruning at the same time, and get to a file first
+        try:
+            if len(parts) == 3 and parts[1] == inputs:
+                current.append((os.path.getmtime(path), path))
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+    for _, path in sorted(current, reverse=True)[TEMPLATE_CACHE_SCALES:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+# How one box's text is laid out, found without drawing anything. See TextBox.measure_text.
+# text_size and box_size are (width, height) along the lines of text, so they're swapped for boxes that wrap on
+# their height. fill_ratio is how much of the box's height the text takes up.
+LayoutMeasurement = namedtuple("LayoutMeasurement", ["box", "font_size", "scale", "line_count", "text_size",
+                                                     "box_size", "fill_ratio", "overflows"])
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with the same hit/miss counters as functools.lru_cache, for values that
+    are looked up by a key built by hand rather than by a function's arguments.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
 
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
 
-def open_image(filepath: str) -> Image.Image:
-    return Image.open(filepath)
 
+@lru_cache(maxsize=None)
+def resolve_font(font_name: str) -> str:
+    """
+    @return str: Path to the font file. Bare filenames are looked for in the fonts folder.
+    """
+    path = font_name
+    if not os.path.dirname(font_name):
+        folder = os.environ.get(FONTS_FOLDER_VARIABLE)
+        if not folder:
+            raise RuntimeError(f"Set the {FONTS_FOLDER_VARIABLE} environment variable to the folder containing "
+                               f"{font_name}")
+        path = os.path.join(folder, font_name)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"Font file not found: {path}")
+    return path
 
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
 def build_font(font_name, font_size) -> ImageFont:
+    instrumentation.count("font_loads")
     return ImageFont.truetype(font_name, font_size)
 
 
+def font_cache_info():
+    """
+    Hit/miss counters for the font cache. Misses are the number of times a font file was actually loaded.
+    """
+    return build_font.cache_info()
+
+
+def get_file_signature(filepath: str) -> Tuple[int, int]:
+    """
+    Cheap stand-in for a file's contents, so that anything cached from it is dropped when the file changes.
+    """
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+@lru_cache(maxsize=None)
+def get_font_file_signature(font_name: str) -> Tuple[int, int]:
+    return get_file_signature(font_name)
+
+
+class WordWidths:
+    """
+    Measures each distinct word once for a given font, so that the width of a line can be built up by adding word
+    widths together rather than measuring the whole line again every time a word is added to it.
+    Kerning between a word and the spaces around it is measured along with the word, which keeps the sums exact for
+    FreeType's basic layout. Other layout engines can shape text in context, so lines that come out close to the
+    maximum width are measured properly instead.
+    """
+
+    def __init__(self, font: ImageFont):
+        self.font = font
+        self.space_width = font.getlength(" ")
+        self.space_space_kerning = font.getlength("  ") - 2 * self.space_width
+        self.is_exact = font.layout_engine == ImageFont.Layout.BASIC
+        self._words = {}
+
+    def get(self, word: str) -> Tuple[float, float, float]:
+        """
+        @return (float, float, float): Width of the word, kerning against a space before it and kerning against a
+            space after it.
+        """
+        metrics = self._words.get(word)
+        if metrics is None:
+            width = self.font.getlength(word)
+            metrics = (
+                width,
+                self.font.getlength(" " + word) - self.space_width - width,
+                self.font.getlength(word + " ") - width - self.space_width,
+            )
+            self._words[word] = metrics
+        return metrics
+
+
+class LineWidth:
+    """
+    Running width of a line that's built up from words and single spaces.
+    """
+
+    def __init__(self, word_widths: WordWidths, width: float = 0.0, trailing_kerning: Optional[float] = None):
+        self.word_widths = word_widths
+        self.width = width
+        # Kerning the last character of the line would add before a space. None if the line is empty.
+        self.trailing_kerning = trailing_kerning
+
+    def copy(self) -> "LineWidth":
+        return LineWidth(self.word_widths, self.width, self.trailing_kerning)
+
+    def add_space(self):
+        if self.trailing_kerning is not None:
+            self.width += self.trailing_kerning
+        self.width += self.word_widths.space_width
+        self.trailing_kerning = self.word_widths.space_space_kerning
+
+    def add_word(self, word: str):
+        if not word:
+            return
+        width, leading_kerning, trailing_kerning = self.word_widths.get(word)
+        # Words only ever follow a space, or start the line
+        if self.trailing_kerning is not None:
+            self.width += leading_kerning
+        self.width += width
+        self.trailing_kerning = trailing_kerning
+
+
+_word_widths = WeakKeyDictionary()
+# CompiledTextBoxes by TextBox and scale, see TextBox.compile
+_compiled_text_boxes = {}
+# CompiledLayoutPlans by LayoutPlan, scale and render scale, see LayoutPlan.compile
+_compiled_layouts = {}
+text_layer_cache = LRUCache(TEXT_LAYER_CACHE_SIZE)
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+
+def get_word_widths(font: ImageFont) -> WordWidths:
+    word_widths = _word_widths.get(font)
+    if word_widths is None:
+        word_widths = _word_widths[font] = WordWidths(font)
+    return word_widths
+
+
+_fit_cache = None
+_fit_cache_dirty = False
+_fit_cache_hits = _fit_cache_misses = 0
+
+
+def fit_cache_info() -> CacheInfo:
+    """
+    Hit/miss counters for the fit cache since the process started. Entries loaded from disk count towards its size.
+    """
+    return CacheInfo(_fit_cache_hits, _fit_cache_misses, None, len(_get_fit_cache()))
+
+
+def _get_fit_cache() -> dict:
+    global _fit_cache
+    if _fit_cache is None:
+        _fit_cache = _read_fit_cache()
+    return _fit_cache
+
+
+def _read_fit_cache() -> dict:
+    try:
+        with open(FIT_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def clear_caches():
+    """
+    Empties every in-memory cache, so that the next card is rendered from scratch. The fit cache and template files
+    on disk are left alone, but the fit cache file isn't read again.
+    """
+    global _fit_cache, _fit_cache_dirty
+    build_font.cache_clear()
+    resolve_font.cache_clear()
+    get_font_file_signature.cache_clear()
+    _word_widths.clear()
+    _compiled_text_boxes.clear()
+    _compiled_layouts.clear()
+    text_layer_cache.clear()
+    template_cache.clear()
+    _fit_cache, _fit_cache_dirty = {}, False
+
+
+@contextmanager
+def _lock_file(path: str):
+    """
+    Holds an exclusive lock on path, created if need be, for the duration. Blocks until any other process or thread
+    holding it lets go.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _get_fit_last_used(entry: Union[list, tuple]) -> float:
+    # Fits saved before they were timestamped count as never used
+    return entry[2] if len(entry) > 2 else 0.0
+
+
+def save_fit_cache():
+    """
+    Writes any newly computed font fits to disk, keeping only the FIT_CACHE_SIZE most recently used. The file is
+    locked while it's read, merged and replaced, so entries written by other processes in the meantime are kept, and
+    parallel workers can all call this without losing each other's work.
+    """
+    global _fit_cache, _fit_cache_dirty
+    if not _fit_cache_dirty:
+        return
+    with _lock_file(FIT_CACHE_LOCK_PATH):
+        fit_cache = _read_fit_cache()
+        # A copy, since the server fits text on other threads while this one saves
+        fit_cache.update(dict(_get_fit_cache()))
+        if len(fit_cache) > FIT_CACHE_SIZE:
+            fit_cache = dict(sorted(fit_cache.items(),
+                                    key=lambda item: _get_fit_last_used(item[1]))[-FIT_CACHE_SIZE:])
+            # Keeps a long-running process's fits bounded too
+            _fit_cache = dict(fit_cache)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(FIT_CACHE_PATH), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(fit_cache, f)
+        os.replace(temp_path, FIT_CACHE_PATH)
+    _fit_cache_dirty = False
+
+
 class TextBox:
 
     def __init__(self, x, y, w, h, halign: HAlign = HAlign.CENTER, valign: VAlign = VAlign.CENTER,
                  font_name: str = DEFAULT_FONT, font_size: int = 50, rotate: int = 0,
-                 use_height_for_text_wrap: bool = False, shrink_font_size_to_fit: bool = False):
+                 use_height_for_text_wrap: bool = False, shrink_font_size_to_fit: bool = False,
+                 cache_rendered_text: bool = True, name: Optional[str] = None):
+        """
+        Args:
+            cache_rendered_text: Keep the finished text layer in text_layer_cache so the same text can just be pasted
+                next time. Turn this off for boxes whose text is different on every card.
+            name: What to call this box in traces.
+        """
         self.x, self.y, self.width, self.height = x, y, w, h
         self.halign, self.valign, self.rotate = halign, valign, rotate
         self.use_height_for_text_wrap = use_height_for_text_wrap
         self.shrink_font_to_fit = shrink_font_size_to_fit
-        self.font_name, self.font_size = font_name, font_size
+        # Resolved by the font_name property on first use, so boxes can be defined before the fonts folder is known
+        self._font_name, self.font_size = font_name, font_size
+        self.cache_rendered_text = cache_rendered_text
+        self.name = name or f"TextBox({x}, {y})"
+
+    @property
+    def font_name(self) -> str:
+        return resolve_font(self._font_name)
+
+    def get_layout_key(self) -> tuple:
+        """
+        Everything about this box that affects how its text is rendered.
+        """
+        return (self.x, self.y, self.width, self.height, self.halign, self.valign, self.rotate,
+                self.use_height_for_text_wrap, self.shrink_font_to_fit, self.font_name, self.font_size)
 
     @staticmethod
     def wrap_text(text, font, max_width=0):
@@ -38,12 +476,25 @@ class TextBox:
         It then starts a new line with that word instead.
         New lines get special treatment. It's kind of funky.
         "Words" are split around spaces.
+        Line widths are added up from per-word widths (see WordWidths) instead of measuring each line over and over.
         """
         text = text.strip("\n")
         if max_width <= 0:
             return text
 
+        word_widths = get_word_widths(font)
+
+        def get_width_with_word(line: str, line_width: LineWidth, word: str) -> float:
+            # Width of the line plus a space and the given word
+            candidate = line_width.copy()
+            candidate.add_space()
+            candidate.add_word(word)
+            if not word_widths.is_exact and abs(candidate.width - max_width) <= font.size:
+                return font.getlength("{} {}".format(line, word))
+            return candidate.width
+
         temp = ""
+        temp_width = LineWidth(word_widths)
         wrapped_text = ""
 
         for w in text.split(' '):
@@ -51,7 +502,7 @@ class TextBox:
             # If next word contains a newline, check only first word before newline for width match
             if "\n" in w:
                 wrapped_text += temp.strip(' ')
-                width = font.getlength("{} {}".format(temp, w.partition('\n')[0]))
+                width = get_width_with_word(temp, temp_width, w.partition('\n')[0])
                 # If adding one last word before the line break will exceed max width
                 # Add in a line break before last word.
                 if width > max_width:
@@ -61,12 +512,18 @@ class TextBox:
                 par = w.rpartition('\n')
                 wrapped_text += par[0] + "\n"
                 temp = par[2] + " "
+                temp_width = LineWidth(word_widths)
+                temp_width.add_word(par[2])
+                temp_width.add_space()
             else:
-                width = font.getlength(u"{0} {1}".format(temp, w))
+                width = get_width_with_word(temp, temp_width, w)
                 if width > max_width:
                     wrapped_text += temp.strip(' ') + "\n"
                     temp = ""
+                    temp_width = LineWidth(word_widths)
                 temp += w + " "
+                temp_width.add_word(w)
+                temp_width.add_space()
         return wrapped_text + temp.strip(' ')
 
     def get_text_block_size(self, text: str, font: ImageFont, width: int, height: int, leading_offset: int = 0
@@ -86,136 +543,323 @@ class TextBox:
 
         return lines, max_line_width, len(lines) * leading
 
-    def shrink_font_until_text_fits(self, text: str, font_name: str, starting_font_size: int, width: int, height: int
-                                    ) -> Tuple[List[str], ImageFont]:
-        font_size = starting_font_size
-        while font_size > 0:
-            font = build_font(font_name, font_size)
-            text_lines, block_width, block_height = self.get_text_block_size(text, font, width, height)
-            if block_width <= width and block_height <= height:
-                print(font_size)
-                return text_lines, font
-            font_size -= 1
+    def shrink_font_until_text_fits(self, text: str, font_name: str, starting_font_size: int, width: int, height: int,
+                                    use_fit_cache: bool = True) -> Tuple[List[str], ImageFont]:
+        """
+        Finds the largest font size, no bigger than starting_font_size, at which the wrapped text fits in the box.
+        Results are kept in the fit cache between runs, unless use_fit_cache is False.
+        """
+        with instrumentation.span("fit", box=self.name):
+            return self._shrink_font_until_text_fits(text, font_name, starting_font_size, width, height, use_fit_cache)
+
+    def _shrink_font_until_text_fits(self, text: str, font_name: str, starting_font_size: int, width: int,
+                                     height: int, use_fit_cache: bool) -> Tuple[List[str], ImageFont]:
+        global _fit_cache_dirty, _fit_cache_hits, _fit_cache_misses
+        cache_key = self.get_fit_cache_key(text, font_name, starting_font_size, width, height)
+        fit_cache = _get_fit_cache() if use_fit_cache else {}
+        if cache_key in fit_cache:
+            _fit_cache_hits += 1
+            font_size, text_lines = fit_cache[cache_key][:2]
+            now = time.time()
+            if now - _get_fit_last_used(fit_cache[cache_key]) > FIT_CACHE_TOUCH_SECONDS:
+                fit_cache[cache_key] = (font_size, text_lines, now)
+                _fit_cache_dirty = True
+            return text_lines, build_font(font_name, font_size)
+
+        def get_lines_if_fits(size: int) -> Optional[List[str]]:
+            instrumentation.count("fit_iterations")
+            font = build_font(font_name, size)
+            lines = self.wrap_text(text, font, height if self.use_height_for_text_wrap else width).split("\n")
+            # The same test as get_text_block_size makes, but the line count alone rules out sizes that are too tall,
+            # which most of the sizes tried are, without measuring a single line
+            if len(lines) * (font.font.ascent + font.font.descent) > height:
+                return None
+            return lines if all(font.getsize(line)[0] <= width for line in lines) else None
+
+        # Fitting isn't monotonic, so a size can fail where a smaller one fits: lines are wrapped by their advance
+        # width but checked with getsize, and boxes that wrap to their height are still checked against their width.
+        # Skipping sizes, e.g. with a binary search, can miss the largest fit, so every size is tried on the way down.
+        # Card text mostly fits at its starting size or the one below, so the scan is short anyway.
+        for font_size in range(starting_font_size, 0, -1):
+            text_lines = get_lines_if_fits(font_size)
+            if text_lines is not None:
+                break
         else:
             raise ValueError("Text is too big to fit in the text box at any font size")
+        if use_fit_cache:
+            _fit_cache_misses += 1
+            fit_cache[cache_key] = (font_size, text_lines, time.time())
+            _fit_cache_dirty = True
+        return text_lines, build_font(font_name, font_size)
+
+    def get_fit_cache_key(self, text: str, font_name: str, starting_font_size: int, width: int, height: int) -> str:
+        # Width, height and starting font size have already been multiplied by the render scale
+        key = [FIT_CACHE_VERSION, text, font_name, get_font_file_signature(font_name), starting_font_size, width,
+               height, self.use_height_for_text_wrap]
+        return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def compile(self, scale: float = 1.0) -> "CompiledTextBox":
+        """
+        @return CompiledTextBox: This box resolved for drawing at scale, which already includes the render scale.
+            Kept for reuse, so the work is only done once per box and scale.
+        """
+        compiled = _compiled_text_boxes.get((self, scale))
+        if compiled is None:
+            compiled = _compiled_text_boxes[self, scale] = CompiledTextBox(self, scale)
+        return compiled
+
+    def add_text(self, image: Union[Image.Image, "LayoutRecorder"], text: str,
+                 color: Union[str, Tuple[int, int, int]] = "black", leading_offset: int = 0, scale: float=1.0
+                 ) -> Tuple[int, int]:
+        """
+        See CompiledTextBox.add_text.
+        """
+        return self.compile(scale * _render_scale).add_text(image, text, color, leading_offset)
+
+    def measure_text(self, text: str, leading_offset: int = 0, scale: float = 1.0) -> LayoutMeasurement:
+        """
+        See CompiledTextBox.measure_text. Unlike add_text, scale isn't multiplied by the render scale.
+        """
+        return self.compile(scale).measure_text(text, leading_offset)
+
+    def render_text_layer(self, text: str, leading_offset: int = 0, scale: float = 1.0
+                          ) -> Tuple[Image.Image, Tuple[int, int], Tuple[int, int]]:
+        """
+        See CompiledTextBox.render_text_layer. Unlike add_text, scale isn't multiplied by the render scale.
+        """
+        return self.compile(scale).render_text_layer(text, leading_offset)
+
+
+class CompiledTextBox:
+    """
+    A TextBox with everything that only depends on the scale worked out ahead of time: its pixel geometry and anchor,
+    font sizes, the font itself for boxes that don't shrink their text, and where lines start for its alignment.
+    """
+    # Where lines start on the virtual canvas, and how much of each line's width goes to the left of that (see
+    # render_text_layer), for each horizontal alignment
+    LINE_STARTS = {HAlign.LEFT: (500, 0), HAlign.CENTER: (2500, 0.5), HAlign.RIGHT: (4500, 1)}
+    # How much of the text layer's height goes above the anchor, in halves, for each vertical alignment
+    LAYER_VALIGN_HALVES = {VAlign.TOP: 0, VAlign.CENTER: 1, VAlign.BOTTOM: 2}
+
+    def __init__(self, box: TextBox, scale: float):
+        if box.halign not in self.LINE_STARTS:
+            raise ValueError(f"Invalid halign value: {box.halign}")
+        if box.valign not in self.LAYER_VALIGN_HALVES:
+            raise ValueError(f"Invalid valign value: {box.valign}")
+        self.box, self.scale, self.name = box, scale, box.name
+        self.font_name = box.font_name
+        self.font_size = int(box.font_size * scale)
+        self.x, self.y = int(box.x * scale), int(box.y * scale)
+        self.width, self.height = int(box.width * scale), int(box.height * scale)
+        self.anchor_x, self.anchor_y = get_anchors(self.x, self.y, self.width, self.height, box.halign, box.valign)
+        self.wrap_width = int((box.height if box.use_height_for_text_wrap else box.width) * scale)
+        # Boxes that shrink their text pick a font for each card
+        self.font = None if box.shrink_font_to_fit else build_font(self.font_name, self.font_size)
+        self.start_x, self.line_alignment = self.LINE_STARTS[box.halign]
+        # Same as line_alignment, but in halves, to keep the layer placement in integers
+        self.layer_halign_halves = round(self.line_alignment * 2)
+        self.layer_valign_halves = self.LAYER_VALIGN_HALVES[box.valign]
+        self.text_cache_key = (box.get_layout_key(), scale) if box.cache_rendered_text else None
+
+    def add_text(self, image: Union[Image.Image, "LayoutRecorder"], text: str,
+                 color: Union[str, Tuple[int, int, int]] = "black", leading_offset: int = 0) -> Tuple[int, int]:
+        """
+        Renders the text with render_text_layer, or takes it from text_layer_cache, and pastes it onto the image.
+        If image is a LayoutRecorder, the text is only measured, and the measurement is added to it.
+
+        @return (int, int): Total width and height of the text block added, in pixels.
+        """
+        if isinstance(image, LayoutRecorder):
+            measurement = self.measure_text(text, leading_offset)
+            image.measurements.append(measurement)
+            return measurement.text_size
+        with instrumentation.span("add_text", box=self.name):
+            cache_key = (self.text_cache_key, text, leading_offset)
+            rendered = text_layer_cache.get(cache_key) if self.text_cache_key else None
+            if rendered is None:
+                rendered = self.render_text_layer(text, leading_offset)
+                if self.text_cache_key:
+                    text_layer_cache.put(cache_key, rendered)
+            layer, coords, total_text_size = rendered
+
+            fill_lut = get_text_fill_lut(color, image.mode)
+            if fill_lut is None:
+                colored_layer = ImageOps.colorize(layer, (255, 255, 255), color)
+            else:
+                colored_layer = layer.point(fill_lut, image.mode)
+            image.paste(colored_layer, coords, layer)
+
+        # Add debug box if the flag is set
+        if DEBUG_TEXT_BOX_BORDERS:
+            draw_box(image, self.x, self.y, self.width, self.height, self.anchor_x, self.anchor_y)
+
+        return total_text_size
+
+    def measure_text(self, text: str, leading_offset: int = 0) -> LayoutMeasurement:
+        """
+        Works out the font size and lines that add_text would use, using only font metrics. Text that doesn't fit at
+        any size is measured at the starting font size.
+        """
+        box = self.box
+        font_size, width, height = self.font_size, self.width, self.height
+        overflows = False
+        if box.shrink_font_to_fit:
+            try:
+                _, font = box.shrink_font_until_text_fits(text, self.font_name, font_size, width, height)
+                font_size = font.size
+            except ValueError:
+                overflows = True
+        lines, text_width, text_height = box.get_text_block_size(
+            text, build_font(self.font_name, font_size), width, height, leading_offset)
+        if box.use_height_for_text_wrap:
+            width, height = height, width
+        overflows = overflows or text_width > width or text_height > height
+        return LayoutMeasurement(self.name, font_size, self.scale, len(lines), (text_width, text_height),
+                                 (width, height), text_height / height, overflows)
 
-    def add_text(self, image: Image.Image, text: str, color: Union[str, Tuple[int, int, int]] = "black",
-                 leading_offset: int = 0, scale: float=1.0) -> Tuple[int, int]:
+    def render_text_layer(self, text: str, leading_offset: int = 0
+                          ) -> Tuple[Image.Image, Tuple[int, int], Tuple[int, int]]:
         """
         First, attempt to wrap the text if max_width is set, and creates a list of each line. Then paste each
         individual line onto a transparent layer one line at a time, taking into account halign. Then rotate the layer,
-        and paste on the image according to the anchor point, halign, and valign.
+        and work out where it goes on the image according to the anchor point, halign, and valign.
 
-        @return (int, int): Total width and height of the text block added, in pixels.
+        @return (Image, (int, int), (int, int)): The text layer, which is also the mask to paste its color with, the
+            coordinates to paste it at, and the total width and height of the text block.
         """
-        if self.shrink_font_to_fit:
-            text_lines, font = self.shrink_font_until_text_fits(
-                text,
-                self.font_name,
-                int(self.font_size * scale),
-                int(self.width * scale),
-                int(self.height * scale),
-            )
+        if self.font is None:
+            text_lines, font = self.box.shrink_font_until_text_fits(text, self.font_name, self.font_size, self.width,
+                                                                    self.height)
         else:
-            font = build_font(self.font_name, int(self.font_size * scale))
-            max_size = self.height if self.use_height_for_text_wrap else self.width
-            wrapped_text = self.wrap_text(
-                text,
-                font,
-                int(max_size * scale)
-            )
-            text_lines = wrapped_text.split('\n')
-
-        # Initialize layer and draw object
-        layer = Image.new('L', (5000, 5000))
-        draw = ImageDraw.Draw(layer)
-        start_y = 500
-        if self.halign == HAlign.LEFT:
-            start_x = 500
-        elif self.halign == HAlign.CENTER:
-            start_x = 2500
-        elif self.halign == HAlign.RIGHT:
-            start_x = 4500
-        else:
-            raise ValueError(f"Invalid halign value: {self.halign}")
+            font = self.font
+            text_lines = self.box.wrap_text(text, font, self.wrap_width).split('\n')
+
+        # Lines are positioned on a virtual 5000x5000 canvas, like the one this code used to draw on. Only the part
+        # that ends up in the final text block actually gets drawn, but keeping the same coordinates keeps the
+        # subpixel placement and rounding of every glyph identical.
+        start_x, start_y, alignment = self.start_x, 500, self.line_alignment
 
         # Set leading
         leading = font.font.ascent + font.font.descent + leading_offset
 
-        # Begin laying down the lines, top to bottom
+        # Lay out the lines, top to bottom
         y = start_y
         max_line_width = 0
+        line_positions = []
         for line in text_lines:
             # If current line is blank, just change y and skip to next
             if not line == "":
                 line_width = font.getlength(line)
-                if self.halign == HAlign.LEFT:
-                    x_pos = start_x
-                elif self.halign == HAlign.CENTER:
-                    x_pos = start_x - (line_width / 2)
-                elif self.halign == HAlign.RIGHT:
-                    x_pos = start_x - line_width
-                else:
-                    raise ValueError(f"Invalid halign value: {self.halign}")
+                x_pos = start_x - line_width * alignment if alignment else start_x
                 # Keep track of the longest line width
                 max_line_width = max(max_line_width, line_width)
-                draw.text((x_pos, y), line, font=font, fill=255)
+                line_positions.append((x_pos, y, line))
             y += leading
 
         total_text_size = (max_line_width, len(text_lines) * leading)
 
-        # Now that the text is added to the image, find the crop points
+        # Find the edges of the text block on the virtual canvas
         top = start_y
         bottom = y - leading_offset
-        if self.halign == HAlign.LEFT:
-            left = start_x
-            right = start_x + max_line_width
-        elif self.halign == HAlign.CENTER:
-            left = start_x - max_line_width / 2
-            right = start_x + max_line_width / 2
-        elif self.halign == HAlign.RIGHT:
-            left = start_x - max_line_width
-            right = start_x
-        else:
-            raise ValueError(f"Invalid halign value: {self.halign}")
-        layer = layer.crop((left, top, right, bottom))
+        left = start_x - max_line_width * alignment
+        right = start_x + max_line_width * (1 - alignment)
+        layer = draw_text_lines(line_positions, font, (round(left), top, round(right), bottom))
         # Now that the image is cropped down to just the text, rotate
-        if self.rotate != 0:
-            layer = layer.rotate(self.rotate, expand=True)
-
-        x, y, width, height = int(self.x * scale), int(self.y * scale), int(self.width * scale), int(self.height * scale)
-        anchor_x, anchor_y = get_anchors(x, y, width, height, self.halign, self.valign)
+        if self.box.rotate != 0:
+            layer = layer.rotate(self.box.rotate, expand=True)
 
-        # Determine the anchor point for the new layer
+        # Place the layer against the anchor point
         layer_width, layer_height = layer.size
-        if self.halign == HAlign.LEFT:
-            coords_x = anchor_x
-        elif self.halign == HAlign.CENTER:
-            coords_x = anchor_x - layer_width // 2
-        elif self.halign == HAlign.RIGHT:
-            coords_x = anchor_x - layer_width
-        else:
-            raise ValueError(f"Invalid halign value: {self.halign}")
-        if self.valign == VAlign.TOP:
-            coords_y = anchor_y
-        elif self.valign == VAlign.CENTER:
-            coords_y = anchor_y - layer_height // 2
-        elif self.valign == VAlign.BOTTOM:
-            coords_y = anchor_y - layer_height
-        else:
-            raise ValueError(f"Invalid valign value: {self.valign}")
+        coords_x = self.anchor_x - layer_width * self.layer_halign_halves // 2
+        coords_y = self.anchor_y - layer_height * self.layer_valign_halves // 2
+        return layer, (coords_x, coords_y), total_text_size
 
-        image.paste(
-            ImageOps.colorize(layer, (255, 255, 255), color),
-            (coords_x, coords_y),
-            layer
-        )
 
-        # Add debug box if the flag is set
-        if DEBUG_TEXT_BOX_BORDERS:
-            draw_box(image, x, y, width, height, anchor_x, anchor_y)
+class ScratchPool:
+    """
+    Keeps a few 'L' images around to draw text into, so that each text box doesn't need a fresh allocation.
+    Buffers only ever grow, and are handed out to one caller at a time.
+    """
+
+    def __init__(self, max_buffers: int = 4, size_step: int = 256):
+        self.max_buffers, self.size_step = max_buffers, size_step
+        self._buffers = []
+        self._lock = threading.Lock()
+
+    def acquire(self, width: int, height: int) -> Image.Image:
+        """
+        @return Image.Image: A buffer at least width x height in size, with that region cleared to 0.
+        """
+        with self._lock:
+            for i, buffer in enumerate(self._buffers):
+                if buffer.width >= width and buffer.height >= height:
+                    del self._buffers[i]
+                    break
+            else:
+                buffer = Image.new('L', (-(-width // self.size_step) * self.size_step,
+                                         -(-height // self.size_step) * self.size_step))
+                # A new buffer is already blank
+                return buffer
+        buffer.paste(0, (0, 0, width, height))
+        return buffer
+
+    def release(self, buffer: Image.Image):
+        with self._lock:
+            self._buffers.append(buffer)
+            if len(self._buffers) > self.max_buffers:
+                # Drop the smallest buffer
+                self._buffers.remove(min(self._buffers, key=lambda b: b.width * b.height))
+
+
+scratch_pool = ScratchPool()
+
+
+@lru_cache(maxsize=None)
+def get_text_fill_lut(color: Union[str, Tuple[int, int, int]], mode: str) -> Optional[List[int]]:
+    """
+    Lookup table for Image.point that turns a text layer straight into the colored layer that
+    ImageOps.colorize(layer, (255, 255, 255), color) makes, in the given image mode, so that it can be pasted without
+    being converted. The table is taken from colorizing a gradient of every gray level, so text comes out exactly as
+    it would from colorize.
+
+    @return [int]: The table, or None if mode isn't RGB or RGBA.
+    """
+    if mode not in ("RGB", "RGBA"):
+        return None
+    gradient = Image.frombytes("L", (256, 1), bytes(range(256)))
+    # One run of 256 values per band of the output
+    lut = []
+    for band in ImageOps.colorize(gradient, (255, 255, 255), color).split():
+        lut += band.tobytes()
+    if mode == "RGBA":
+        # colorize makes an RGB layer, which paste would convert to RGBA with full alpha
+        lut += [255] * 256
+    return lut
 
-        return total_text_size
+
+def draw_text_lines(line_positions: List[Tuple[float, int, str]], font: ImageFont, crop_box: Tuple[int, int, int, int]
+                    ) -> Image.Image:
+    """
+    Draws each (x, y, line) onto a transparent layer and returns the part of it that falls within crop_box.
+    Coordinates are relative to the same origin as crop_box, but only the cropped area is ever allocated.
+    """
+    left, top, right, bottom = crop_box
+    width, height = max(right - left, 0), max(bottom - top, 0)
+    if width == 0 or height == 0:
+        return Image.new('L', (width, height))
+    # The text gets drawn one pixel in from the edge, so that no line starts at a negative x. Pillow truncates the
+    # integer part of the position and renders the fraction as a subpixel offset, so x has to stay positive for the
+    # glyphs to land exactly where they would on a larger canvas.
+    padding = 1
+    offset_x, offset_y = left - padding, top
+    buffer = scratch_pool.acquire(width + padding, height)
+    try:
+        draw = ImageDraw.Draw(buffer)
+        for x, y, line in line_positions:
+            draw.text((x - offset_x, y - offset_y), line, font=font, fill=255)
+        return buffer.crop((padding, 0, padding + width, height))
+    finally:
+        scratch_pool.release(buffer)
 
 
 def draw_box(image, x: int, y: int, width: int, height: int, anchor_x=None, anchor_y=None, color="red"):
@@ -274,6 +918,191 @@ def add_class_icon(im: Image, dirname: str):
         im.paste(symbol, box=(3, 986))
 
 
+class LayoutRecorder:
+    """
+    Stands in for a card image, so that a class module's add_text can be run without drawing anything. Every
+    TextBox.add_text call made with it measures the text instead, and the measurements are collected here.
+    """
+
+    def __init__(self):
+        self.measurements: List[LayoutMeasurement] = []
+
+
+def _conditions_hold(toml_dict: dict, when: Optional[str], unless: Optional[str]) -> bool:
+    return (when is None or bool(toml_dict[when])) and (unless is None or not toml_dict[unless])
+
+
+class Field(NamedTuple):
+    """
+    A text box on a card, filled with one of the card's fields.
+
+    Args:
+        optional: Leave the box off cards that don't have the field at all.
+        when: Only draw the box on cards where this other field is filled in.
+        unless: Only draw the box on cards where this other field is empty.
+    """
+    box: TextBox
+    field: str
+    optional: bool = False
+    when: Optional[str] = None
+    unless: Optional[str] = None
+
+    def applies_to(self, toml_dict: dict) -> bool:
+        if self.optional and self.field not in toml_dict:
+            return False
+        return _conditions_hold(toml_dict, self.when, self.unless)
+
+
+class Template(NamedTuple):
+    """
+    A template a card can be drawn on. path is formatted with the card's fields, with spaces turned into underscores,
+    e.g. templates/Template_{action}.png. when and unless work the same as for Field.
+    """
+    path: str
+    when: Optional[str] = None
+    unless: Optional[str] = None
+
+    def applies_to(self, toml_dict: dict) -> bool:
+        return _conditions_hold(toml_dict, self.when, self.unless)
+
+    def get_path(self, toml_dict: dict) -> str:
+        return self.path.format(**{k: str(v).replace(" ", "_") for k, v in toml_dict.items()})
+
+
+class LayoutPlan:
+    """
+    How a class draws its cards: which template each card goes on, and which fields go in which text boxes, in the
+    order they're drawn. Plans are compiled for each scale they're drawn at (see CompiledLayoutPlan), so every card
+    just runs through a list of boxes that are ready to draw.
+    """
+
+    def __init__(self, templates: List[Template], fields: List[Field], scale: float = 1.0,
+                 icon_dirname: Optional[str] = None):
+        """
+        Args:
+            templates: The first template that applies to a card and exists is used. If none of them exist, the first
+                one that applies is, so that the error names it.
+            scale: Size the class draws its cards at, compared to a normal card, e.g. 3/2 for 2x2 pages.
+            icon_dirname: See add_class_icon.
+        """
+        self.templates, self.fields, self.scale, self.icon_dirname = templates, fields, scale, icon_dirname
+
+    @property
+    def boxes(self) -> List[TextBox]:
+        return [field.box for field in self.fields]
+
+    def compile(self, scale: float = 1.0) -> "CompiledLayoutPlan":
+        """
+        @return CompiledLayoutPlan: This plan for drawing cards at scale times the class's size, at the current render
+            scale. Kept for reuse.
+        """
+        key = (self, scale, _render_scale)
+        compiled = _compiled_layouts.get(key)
+        if compiled is None:
+            compiled = _compiled_layouts[key] = CompiledLayoutPlan(self, scale)
+        return compiled
+
+
+class CompiledLayoutPlan:
+    """
+    A LayoutPlan at one scale, with every text box compiled.
+    """
+
+    def __init__(self, plan: LayoutPlan, scale: float):
+        self.plan = plan
+        # load_template applies the render scale itself, text boxes are compiled with it
+        self.template_scale = plan.scale * scale
+        self.fields = [(field, field.box.compile(self.template_scale * _render_scale)) for field in plan.fields]
+
+    def get_template(self, toml_dict: dict) -> Image.Image:
+        templates = [template for template in self.plan.templates if template.applies_to(toml_dict)]
+        if not templates:
+            raise ValueError(f"None of the templates apply to {toml_dict.get('name')!r}")
+        paths = [template.get_path(toml_dict) for template in templates]
+        path = next((path for path in paths if os.path.isfile(path)), paths[0])
+        return load_template(path, scale=self.template_scale, icon_dirname=self.plan.icon_dirname)
+
+    def add_text(self, image: Union[Image.Image, LayoutRecorder], toml_dict: dict):
+        for field, box in self.fields:
+            if field.applies_to(toml_dict):
+                box.add_text(image, toml_dict[field.field])
+
+    def render(self, toml_dict: dict) -> Image.Image:
+        im = self.get_template(toml_dict)
+        self.add_text(im, toml_dict)
+        return im
+
+
+# Width and height in inches
+PAPER_SIZES = {
+    "letter": (8.5, 11.0),
+    "a4": (8.27, 11.69),
+}
+
+
+class PageCompositor:
+    """
+    Lays cards out on a printable page of paper_size inches at the given dpi one at a time, in a grid defined by
+    grid_width, grid_height, with cut_line_width pixels of white between them. The grid is centered on the page. Cards
+    are pasted as soon as they're added, so only the page itself needs to stay in memory.
+    Cards are resized by card_scale as they're pasted, and shrunk further if the grid wouldn't fit on the page.
+    Assumes that all the cards are the same size.
+    """
+
+    def __init__(self, grid: Tuple[int, int], cut_line_width: int = 3, dpi: int = 300,
+                 paper_size: Tuple[float, float] = PAPER_SIZES["letter"], card_scale: float = 1.0):
+        self.grid, self.cut_line_width, self.dpi = grid, cut_line_width, dpi
+        self.paper_size, self.card_scale = paper_size, card_scale
+        self.page = None
+        self.card_size = self.offset = None
+
+    @property
+    def slot_count(self) -> int:
+        return self.grid[0] * self.grid[1]
+
+    def add_card(self, card: Image.Image, slot: int):
+        """
+        Pastes the card into the given slot, counting top down, left to right.
+        """
+        if self.page is None:
+            self._start_page(card.size)
+        w, h = self.card_size
+        # Cards saved as palette PNGs are resized and pasted the same as the truecolor card they came from
+        if card.mode == "P":
+            card = card.convert("RGBA")
+        if card.size != self.card_size:
+            resample = Image.Resampling.LANCZOS if _render_scale == 1.0 else PREVIEW_RESAMPLE
+            with instrumentation.span("resize_card"):
+                card = card.resize(self.card_size, resample)
+        x, y = slot % self.grid[0], slot // self.grid[0]
+        self.page.paste(card, (self.offset[0] + x * (w + self.cut_line_width),
+                               self.offset[1] + y * (h + self.cut_line_width)))
+
+    def _start_page(self, card_size: Tuple[int, int]):
+        # Create a paper image the exact size of the paper to paste the card images onto
+        paper_width = int(self.paper_size[0] * self.dpi)
+        paper_height = int(self.paper_size[1] * self.dpi)
+        self.page = Image.new("RGB", (paper_width, paper_height), (255, 255, 255))
+        # Size the card grid based on the size of the first card, shrinking it if it's bigger than the paper
+        scale = min(self.card_scale,
+                    (paper_width / self.grid[0] - self.cut_line_width) / card_size[0],
+                    (paper_height / self.grid[1] - self.cut_line_width) / card_size[1])
+        if scale != 1.0:
+            card_size = round(scale * card_size[0]), round(scale * card_size[1])
+        self.card_size = w, h = card_size
+        grid_width = (w + self.cut_line_width) * self.grid[0]
+        grid_height = (h + self.cut_line_width) * self.grid[1]
+        self.offset = ((paper_width - grid_width) // 2, (paper_height - grid_height) // 2)
+
+    def finish_page(self) -> Image.Image:
+        """
+        @return Image: The finished page. Empty slots are left white. The next card added starts a new page.
+        """
+        page = self.page
+        self.page = None
+        return page
+
+
 def save_page(card_list: List[Image], grid: Tuple[int, int], filename, cut_line_width=3,
               page_ratio=8.5 / 11.0, h_margin=100):
     """
@@ -281,58 +1110,76 @@ def save_page(card_list: List[Image], grid: Tuple[int, int], filename, cut_line_
     It then adds a border to the grid, making sure to preserve the
     page ratio for later printing, and saves to filename
     Assumes that all the cards are the same size
+    The cards that were put on the page are removed from the front of card_list.
     """
-    # Create card grid based on size of the first card
-    w, h = card_list[0].size
-    bg = Image.new(
-        "RGB",
-        (
-            (w + cut_line_width) * grid[0],
-            (h + cut_line_width) * grid[1]
-        ),
-        color="white"
-    )
-    blank_image = Image.new("RGB", (w, h), color="white")
-    # Add cards to the grid, top down, left to right
-    for y in range(grid[1]):
-        for x in range(grid[0]):
-            if not card_list:
-                # Card list ran out of images. Use blank images to fill out grid remainder
-                card = blank_image
-            else:
-                card = card_list.pop(0)
-            coords = (x * (w + cut_line_width),
-                      y * (h + cut_line_width))
-            bg.paste(card, coords)
-    # If there's a margin defined, add extra whitespace around the page
-    # if h_margin > 0:
-    #     w,h = bg.size
-    #     w_margin = (((h_margin*2)+h)*page_ratio-w)/2.0
-    #     w_margin = round(w_margin)
-    #     page = Image.new("RGB", (int(w+w_margin*2), int(h+h_margin*2)), (255, 255, 255))
-    #     page.paste(bg, (w_margin,h_margin))
-    #     page.save(filename)
-    # else:
-    # bg.save(filename)
-    # Create a paper image the exact size of an 8.5x11 paper
-    # to paste the card images onto
-    paper_width = int(8.5 * 300)  # 8.5 inches times 300 dpi
-    paper_height = int(11 * 300)  # 11 inches times 300 dpi
-    paper_image = Image.new("RGB", (paper_width, paper_height), (255, 255, 255))
-    w, h = bg.size
-    # TODO Add code that shrinks the bg if it's bigger than any dimension
-    # of the Paper image
-    paper_image.paste(bg, ((paper_width - w) // 2, (paper_height - h) // 2))
-    paper_image.save(filename, dpi=(300, 300))
+    compositor = PageCompositor(grid, cut_line_width)
+    page_cards = card_list[:compositor.slot_count]
+    del card_list[:compositor.slot_count]
+    for slot, card in enumerate(page_cards):
+        compositor.add_card(card, slot)
+    compositor.finish_page().save(filename, dpi=(300, 300))
+
+
+class Palette(NamedTuple):
+    """
+    Save PNGs with an adaptive palette of up to this many colors, unless that changes any part of them by more than
+    max_error.
+    """
+    colors: int = DEFAULT_PALETTE_COLORS
+    max_error: float = DEFAULT_PALETTE_MAX_ERROR
+
+
+def quantize_image(image: Image.Image, palette: Palette) -> Tuple[Image.Image, float]:
+    """
+    Reduces an RGB or RGBA image to an adaptive palette. Transparency is kept in the palette, which PNG supports.
+
+    @return (Image, float): The palette image, or the image itself if the palette image is more than
+        palette.max_error away from it, and the error: the RMS difference of the worst channel in the worst
+        PALETTE_ERROR_TILE square.
+    """
+    with instrumentation.span("quantize", colors=palette.colors):
+        # Fast octree is the only method Pillow has for RGBA without libimagequant, and is quicker than median cut.
+        # Without a fixed palette nothing is dithered, so the same image always gives the same pixels.
+        quantized = image.quantize(palette.colors, method=Image.Quantize.FASTOCTREE)
+        difference = ImageChops.difference(quantized.convert(image.mode), image)
+        worst_mean_square = 0.0
+        for band in difference.split():
+            # Averaging the squared differences down by the tile size gives each tile's mean square in one pass
+            squares = ImageMath.eval("float(a) * float(a)", a=band)
+            worst_mean_square = max(worst_mean_square, squares.reduce(PALETTE_ERROR_TILE).getextrema()[1])
+        error = math.sqrt(worst_mean_square)
+    return (quantized if error <= palette.max_error else image), error
+
+
+def apply_palette(image: Image.Image, palette: Optional[Palette], name: str) -> Image.Image:
+    """
+    @return Image: The image quantized to the palette (see quantize_image), or the image itself if palette is None or
+        quantizing it would lose too much. Says so when it does.
+    """
+    if palette is None or image.mode not in ("RGB", "RGBA"):
+        return image
+    quantized, error = quantize_image(image, palette)
+    if quantized is image:
+        print(f"Saving {name} in truecolor, since {palette.colors} colors would change it by {error:.1f} "
+              f"(more than {palette.max_error})")
+    return quantized
+
+
+def save_png(image: Image.Image, filename: str, palette: Optional[Palette] = None, **params):
+    """
+    Saves the image to filename with the same params as Image.save, as a palette PNG if palette is given (see
+    apply_palette).
+    """
+    apply_palette(image, palette, filename).save(filename, **params)
 
 
 action_box = TextBox(0, 50, 67, 500, halign=HAlign.RIGHT, valign=VAlign.TOP, rotate=90,
-                     font_name=os.path.join(FONTS_FOLDER, "Astoria_Sans_Extended_Bold.otf"),
-                     use_height_for_text_wrap=True)
-name_box = TextBox(92, 47, 631, 82, shrink_font_size_to_fit=True)
+                     font_name="Astoria_Sans_Extended_Bold.otf",
+                     use_height_for_text_wrap=True, name="action")
+name_box = TextBox(92, 47, 631, 82, shrink_font_size_to_fit=True, cache_rendered_text=False, name="name")
 description_box = TextBox(105, 150, 610, 700,
                           font_size=32, halign=HAlign.LEFT, valign=VAlign.TOP, font_name=TEXT_FONT,
-                          shrink_font_size_to_fit=True)
-footnote_box = TextBox(105, 860, 610, 50, font_size=32, font_name=TEXT_FONT)
-source_box = TextBox(125, 933, 382, 82, font_name=TEXT_FONT, shrink_font_size_to_fit=True)
-level_box = TextBox(560, 933, 163, 82)
\ No newline at end of file
+                          shrink_font_size_to_fit=True, cache_rendered_text=False, name="description")
+footnote_box = TextBox(105, 860, 610, 50, font_size=32, font_name=TEXT_FONT, name="footnote")
+source_box = TextBox(125, 933, 382, 82, font_name=TEXT_FONT, shrink_font_size_to_fit=True, name="source")
+level_box = TextBox(560, 933, 163, 82, name="level")
\ No newline at end of file
@@ -0,0 +1,261 @@
+import argparse
+import base64
+import io
+import json
+import threading
+import time
+import tomllib
+from collections import defaultdict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import ModuleType
+from typing import Dict, Any, Tuple, List, Optional
+
+from PIL import Image
+
+from catalog import get_class_names, get_class_module
+from instrumentation import get_percentile
+from main import build_card_from_dict
+from pdf_writer import PdfWriter, PDF_ENCODINGS
+from pil_helpers import PageCompositor, save_fit_cache, font_cache_info, fit_cache_info, text_layer_cache, \
+    template_cache, Palette, apply_palette
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8377
+# Requests bigger than this are turned away rather than read into memory
+MAX_REQUEST_BYTES = 10 * 2 ** 20
+# Latencies kept per endpoint for the percentiles in /metrics
+LATENCY_SAMPLES = 1000
+
+
+class BadRequest(Exception):
+    pass
+
+
+def get_int_field(request: Dict[str, Any], name: str, default: int, minimum: int, maximum: Optional[int] = None) -> int:
+    """
+    @return int: request[name], or default if it's not given.
+    @raise BadRequest: If it's not a whole number from minimum to maximum.
+    """
+    value = request.get(name, default)
+    # bool is an int too, but true isn't a level
+    if type(value) is not int or value < minimum or (maximum is not None and value > maximum):
+        expected = f"from {minimum} to {maximum}" if maximum is not None else f"of at least {minimum}"
+        raise BadRequest(f"Invalid {name}: {value}. Expected a whole number {expected}")
+    return value
+
+
+class RenderService:
+    """
+    Renders batches of cards for the HTTP handler, and keeps the numbers reported by /metrics. Fonts, templates, text
+    layers and font fits are cached by pil_helpers for the life of the process, so they stay warm across requests.
+
+    A request is a JSON object, or a TOML document with the same layout:
+        class: Class module used for every card that doesn't name its own "class"
+        cards: List of cards, each with the same fields as an ability TOML
+        output: "png" (default) for a JSON list of base64 card PNGs, or "pdf" for a PDF of pages of cards
+        grid: Cards across and down each PDF page, as [columns, rows]. Defaults to 2x2 for classes with large cards,
+            3x3 otherwise
+        palette: Number of colors for palette PNGs, as for main.py --palette. Only applies to png output
+        minimum_level, compress_level, pdf_encoding, quality: As for main.py
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+        self._counts = defaultdict(int)
+        self._errors = defaultdict(int)
+        self._cards_rendered = 0
+
+    def record(self, endpoint: str, seconds: float, failed: bool):
+        with self._lock:
+            self._latencies[endpoint].append(seconds * 1000)
+            self._counts[endpoint] += 1
+            self._errors[endpoint] += failed
+
+    def render(self, request: Dict[str, Any]) -> Tuple[str, bytes]:
+        """
+        @return (str, bytes): Content type and body of the response.
+        """
+        if not isinstance(request, dict):
+            raise BadRequest("Expected an object with a list of cards")
+        cards = request.get("cards")
+        if not isinstance(cards, list) or not cards:
+            raise BadRequest("Expected a non-empty list of cards")
+        if not all(isinstance(card, dict) for card in cards):
+            raise BadRequest("Expected every card to be an object")
+        output = request.get("output", "png")
+        if output not in ("png", "pdf"):
+            raise BadRequest(f"Invalid output: {output}. Expected png or pdf")
+        minimum_level = get_int_field(request, "minimum_level", 1, 1)
+        compress_level = get_int_field(request, "compress_level", 6, 0, 9)
+        quality = get_int_field(request, "quality", 90, 1, 95)
+        palette = request.get("palette")
+        if palette is not None:
+            if not isinstance(palette, int) or not 2 <= palette <= 256:
+                raise BadRequest(f"Invalid palette: {palette}. Expected a number of colors from 2 to 256")
+            palette = Palette(palette)
+
+        rendered = []
+        for card in cards:
+            class_name = card.get("class", request.get("class"))
+            if class_name not in get_class_names():
+                raise BadRequest(f"Unknown class: {class_name}. Expected one of {get_class_names()}")
+            class_module = get_class_module(class_name)
+            try:
+                im = build_card_from_dict(class_module, card, minimum_level)
+            except KeyError as e:
+                raise BadRequest(f"Card {card.get('name')!r} is missing the {e} field")
+            rendered.append((class_module, card, im))
+        with self._lock:
+            self._cards_rendered += sum(im is not None for _, _, im in rendered)
+        # Share any new font fits with the next process too
+        save_fit_cache()
+
+        if output == "png":
+            results = []
+            for _, card, im in rendered:
+                png = None
+                if im is not None:
+                    buffer = io.BytesIO()
+                    apply_palette(im, palette, card.get("name")).save(buffer, format="PNG",
+                                                                      compress_level=compress_level)
+                    png = base64.b64encode(buffer.getvalue()).decode("ascii")
+                results.append({"name": card.get("name"), "png": png})
+            return "application/json", json.dumps({"cards": results}).encode("utf-8")
+        rendered = [(class_module, im) for class_module, _, im in rendered if im is not None]
+        if not rendered:
+            raise BadRequest("Every card was skipped, so there are no pages to make")
+        return "application/pdf", self.render_pages(rendered, request, compress_level, quality)
+
+    @staticmethod
+    def render_pages(rendered: List[Tuple[ModuleType, Image.Image]], request: Dict[str, Any], compress_level: int,
+                     quality: int) -> bytes:
+        pdf_encoding = request.get("pdf_encoding", "flate")
+        if pdf_encoding not in PDF_ENCODINGS:
+            raise BadRequest(f"Invalid pdf_encoding: {pdf_encoding}. Expected one of {PDF_ENCODINGS}")
+        grid = request.get("grid")
+        if grid is None:
+            # Same as main: cards scaled up by their class module go 2x2, normal ones 3x3
+            grid = (2, 2) if rendered[0][0].LAYOUT.scale > 1 else (3, 3)
+        elif not isinstance(grid, list) or len(grid) != 2 or not all(type(n) is int and n > 0 for n in grid):
+            raise BadRequest(f"Invalid grid: {grid}. Expected [columns, rows], e.g. [3, 3]")
+        compositor = PageCompositor(tuple(grid), cut_line_width=10)
+        buffer = io.BytesIO()
+        with PdfWriter(buffer) as pdf_writer:
+            for i in range(0, len(rendered), compositor.slot_count):
+                for slot, (_, im) in enumerate(rendered[i:i + compositor.slot_count]):
+                    compositor.add_card(im, slot)
+                pdf_writer.add_page(compositor.finish_page(), dpi=300, encoding=pdf_encoding,
+                                    compress_level=compress_level, quality=quality)
+        return buffer.getvalue()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = {}
+            for endpoint, latencies in self._latencies.items():
+                samples = sorted(latencies)
+                endpoints[endpoint] = {
+                    "count": self._counts[endpoint],
+                    "errors": self._errors[endpoint],
+                    **{f"p{p}_ms": get_percentile(samples, p) for p in (50, 90, 99)},
+                    "max_ms": samples[-1],
+                }
+            cards_rendered = self._cards_rendered
+        caches = {
+            "fonts": font_cache_info(),
+            "fits": fit_cache_info(),
+            "text_layers": text_layer_cache.cache_info(),
+            "templates": template_cache.cache_info(),
+        }
+        return {
+            "uptime_s": time.time() - self.started,
+            "cards_rendered": cards_rendered,
+            "endpoints": endpoints,
+            "caches": {name: dict(info._asdict(), hit_rate=info.hits / (info.hits + info.misses)
+                                  if info.hits + info.misses else None) for name, info in caches.items()},
+        }
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /render renders a batch of cards (see RenderService). GET /metrics returns latencies and cache hit rates.
+    """
+    service: RenderService = None
+
+    def do_GET(self):
+        start = time.perf_counter()
+        if self.path == "/metrics":
+            self.send_body(200, "application/json", json.dumps(self.service.get_metrics(), indent=2).encode("utf-8"))
+        else:
+            self.send_error_body(404, f"No such endpoint: {self.path}")
+        self.service.record(f"GET {self.path}", time.perf_counter() - start, False)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        failed = True
+        try:
+            if self.path != "/render":
+                self.send_error_body(404, f"No such endpoint: {self.path}")
+                return
+            content_type, body = self.service.render(self.read_request())
+            self.send_body(200, content_type, body)
+            failed = False
+        except (BadRequest, ValueError) as e:
+            # ValueErrors come from the rendering code, for things like text that can't fit on the card
+            self.send_error_body(400, str(e))
+        except Exception as e:
+            self.send_error_body(500, f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self.service.record(f"POST {self.path}", time.perf_counter() - start, failed)
+
+    def read_request(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_REQUEST_BYTES:
+            raise BadRequest(f"Request is bigger than {MAX_REQUEST_BYTES} bytes")
+        body = self.rfile.read(length).decode("utf-8")
+        content_type = self.headers.get("Content-Type", "application/json").split(";")[0].strip()
+        try:
+            if content_type in ("application/toml", "text/toml"):
+                return tomllib.loads(body)
+            return json.loads(body)
+        except (tomllib.TOMLDecodeError, json.JSONDecodeError) as e:
+            raise BadRequest(f"Couldn't parse the request as {content_type}: {e}")
+
+    def send_body(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_body(self, status: int, message: str):
+        self.send_body(status, "application/json", json.dumps({"error": message}).encode("utf-8"))
+
+
+def make_server(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, warm: bool = True) -> ThreadingHTTPServer:
+    """
+    Args:
+        warm: Import every class module up front, rather than on the first request for each.
+    """
+    if warm:
+        for class_name in get_class_names():
+            get_class_module(class_name)
+    RenderRequestHandler.service = RenderService()
+    return ThreadingHTTPServer((host, port), RenderRequestHandler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve card renders over HTTP from a long-running process.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Address to listen on (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT})")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port)
+    print(f"Rendering cards at http://{args.host}:{server.server_port}/render, metrics at /metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
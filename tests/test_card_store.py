@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+from PIL import Image
+
+from card_store import CardStore
+from catalog import get_class_module
+from pil_helpers import FONTS_FOLDER_VARIABLE, Palette
+
+CARD = {"name": "Dash", "level": "1", "action": "Action", "description": "You move twice as far."}
+
+
+class CardStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store_folder = os.path.join(self.folder.name, "cards")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def render_card(self, store: CardStore, key: str, filename: str) -> str:
+        output_path = os.path.join(self.folder.name, filename)
+        Image.new("RGB", (20, 30), "red").save(output_path)
+        store.add(key, output_path, render_seconds=0.5)
+        return output_path
+
+    def test_card_with_the_same_key_is_reused(self):
+        store = CardStore(self.store_folder)
+        rendered_path = self.render_card(store, "ab12", "rendered.png")
+        store.save()
+
+        # A later build, in another output folder
+        store = CardStore(self.store_folder)
+        output_path = os.path.join(self.folder.name, "reused.png")
+        self.assertTrue(store.get("ab12", output_path))
+        with open(rendered_path, "rb") as rendered, open(output_path, "rb") as reused:
+            self.assertEqual(rendered.read(), reused.read())
+        self.assertEqual(store.session["hits"], 1)
+        self.assertEqual(store.session["render_seconds_saved"], 0.5)
+
+    def test_card_with_another_key_is_not_reused(self):
+        store = CardStore(self.store_folder)
+        self.render_card(store, "ab12", "rendered.png")
+        store.save()
+        store = CardStore(self.store_folder)
+        output_path = os.path.join(self.folder.name, "other.png")
+        self.assertFalse(store.get("cd34", output_path))
+        self.assertFalse(os.path.exists(output_path))
+
+    def test_missing_png_is_not_reused(self):
+        store = CardStore(self.store_folder)
+        self.render_card(store, "ab12", "rendered.png")
+        store.save()
+        os.remove(store.get_path("ab12"))
+        self.assertFalse(CardStore(self.store_folder).get("ab12", os.path.join(self.folder.name, "reused.png")))
+
+    def test_gc_removes_least_recently_used(self):
+        store = CardStore(self.store_folder)
+        self.render_card(store, "ab12", "first.png")
+        self.render_card(store, "cd34", "second.png")
+        store.save()
+        store.entries["ab12"]["last_used"] -= 60
+        removed, _ = store.gc(max_bytes=store.entries["cd34"]["size"])
+        self.assertEqual(removed, 1)
+        self.assertEqual(list(store.entries), ["cd34"])
+        self.assertFalse(os.path.exists(store.get_path("ab12")))
+
+    @unittest.skipUnless(os.environ.get(FONTS_FOLDER_VARIABLE), f"Needs the fonts, in ${FONTS_FOLDER_VARIABLE}")
+    def test_key_changes_with_what_is_drawn(self):
+        class_module = get_class_module("common")
+        store = CardStore(self.store_folder)
+        key = store.get_key("common", class_module, CARD, 1.0)
+        self.assertEqual(store.get_key("common", class_module, dict(CARD), 1.0), key)
+        # skip decides whether a card is built, not how it looks
+        self.assertEqual(store.get_key("common", class_module, dict(CARD, skip=False), 1.0), key)
+        self.assertNotEqual(store.get_key("common", class_module, dict(CARD, description="Twice."), 1.0), key)
+        self.assertNotEqual(store.get_key("common", class_module, CARD, 2.0), key)
+        self.assertNotEqual(store.get_key("common", class_module, CARD, 1.0, Palette(64)), key)
+
+        self.render_card(store, key, "dash.png")
+        store.save()
+        store = CardStore(self.store_folder)
+        changed_key = store.get_key("common", class_module, dict(CARD, description="Twice."), 1.0)
+        self.assertTrue(store.get(key, os.path.join(self.folder.name, "same.png")))
+        self.assertFalse(store.get(changed_key, os.path.join(self.folder.name, "changed.png")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+
+from catalog import get_class_module
+from manifest import Manifest
+from pil_helpers import FONTS_FOLDER_VARIABLE
+
+TOML = 'name = "Dash"\nlevel = "1"\naction = "Action"\ndescription = "You move twice as far."\n'
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "manifest.json")
+        self.card_path = os.path.join(self.folder.name, "dash.png")
+        with open(self.card_path, "wb"):
+            pass
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_card_is_current_until_its_digest_changes(self):
+        manifest = Manifest(self.path)
+        manifest.set_card("dash.toml", "ab12", self.card_path)
+        manifest.set_card("skipped.toml", "cd34", None)
+        manifest.save()
+
+        manifest = Manifest(self.path)
+        self.assertEqual(manifest.get_current_card("dash.toml", "ab12"), (True, self.card_path))
+        self.assertEqual(manifest.get_current_card("skipped.toml", "cd34"), (True, None))
+        self.assertEqual(manifest.get_current_card("dash.toml", "ef56"), (False, None))
+        self.assertEqual(manifest.get_current_card("hide.toml", "ab12"), (False, None))
+
+    def test_card_whose_png_is_gone_is_not_current(self):
+        manifest = Manifest(self.path)
+        manifest.set_card("dash.toml", "ab12", self.card_path)
+        os.remove(self.card_path)
+        self.assertEqual(manifest.get_current_card("dash.toml", "ab12"), (False, None))
+
+    def test_nothing_is_current_without_reuse(self):
+        manifest = Manifest(self.path)
+        manifest.set_card("dash.toml", "ab12", self.card_path)
+        manifest.set_page(self.card_path, "ef56")
+        manifest.save()
+
+        manifest = Manifest(self.path, reuse=False)
+        self.assertEqual(manifest.get_current_card("dash.toml", "ab12"), (False, None))
+        self.assertFalse(manifest.is_page_current(self.card_path, "ef56"))
+        # Still recorded for the next incremental build
+        self.assertIn("dash.toml", manifest.cards)
+
+    def test_page_is_current_while_its_cards_are(self):
+        manifest = Manifest(self.path)
+        digest = Manifest.get_page_digest(["ab12", "cd34"], (3, 3), "png")
+        manifest.set_page(self.card_path, digest)
+        self.assertTrue(manifest.is_page_current(self.card_path, digest))
+        self.assertFalse(manifest.is_page_current(self.card_path, Manifest.get_page_digest(["ab12", "ef56"],
+                                                                                            (3, 3), "png")))
+        self.assertFalse(manifest.is_page_current(self.card_path, Manifest.get_page_digest(["ab12", "cd34"],
+                                                                                            (2, 2), "png")))
+        # A page with a card whose digest isn't known can't be current, and isn't recorded
+        self.assertIsNone(Manifest.get_page_digest(["ab12", None], (3, 3), "png"))
+        manifest.set_page(self.card_path, None)
+        self.assertNotIn(self.card_path, manifest.pages)
+
+    @unittest.skipUnless(os.environ.get(FONTS_FOLDER_VARIABLE), f"Needs the fonts, in ${FONTS_FOLDER_VARIABLE}")
+    def test_card_digest_changes_with_its_toml(self):
+        class_module = get_class_module("common")
+        toml_path = os.path.join(self.folder.name, "dash.toml")
+        with open(toml_path, "w") as f:
+            f.write(TOML)
+        manifest = Manifest(self.path)
+        digest = manifest.get_card_digest("common", class_module, toml_path, 1)
+        self.assertEqual(manifest.get_card_digest("common", class_module, toml_path, 1), digest)
+        self.assertNotEqual(manifest.get_card_digest("common", class_module, toml_path, 2), digest)
+        self.assertNotEqual(manifest.get_card_digest("common", class_module, toml_path, 1, scale=2.0), digest)
+        with open(toml_path, "w") as f:
+            f.write(TOML.replace("twice", "trice"))
+        # Same size, so only a different mtime gives it away
+        os.utime(toml_path, ns=(0, 0))
+        self.assertNotEqual(manifest.get_card_digest("common", class_module, toml_path, 1), digest)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import io
+import random
+import unittest
+
+from PIL import Image
+
+from pdf_writer import PdfWriter
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+
+def make_page(size=(240, 330), mode: str = "RGB", seed: int = 0) -> Image.Image:
+    """
+    A page of random blocks, so that every page's pixels are different.
+    """
+    rng = random.Random(seed)
+    page = Image.new(mode, size, "white")
+    for _ in range(20):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        color = tuple(rng.randrange(256) for _ in range(len(mode)))
+        page.paste(color if mode != "L" else color[0], (x, y, min(x + 40, size[0]), min(y + 40, size[1])))
+    return page
+
+
+@unittest.skipUnless(pypdf, "Needs pypdf to read the PDFs back")
+class PdfWriterTest(unittest.TestCase):
+
+    def write_pdf(self, pages, **params) -> "pypdf.PdfReader":
+        buffer = io.BytesIO()
+        with PdfWriter(buffer) as pdf_writer:
+            for page in pages:
+                pdf_writer.add_page(page, **params)
+            self.assertEqual(pdf_writer.page_count, len(pages))
+        return pypdf.PdfReader(io.BytesIO(buffer.getvalue()))
+
+    def test_pages_and_media_boxes(self):
+        pages = [make_page(seed=i) for i in range(3)]
+        reader = self.write_pdf(pages, dpi=300)
+        self.assertEqual(len(reader.pages), 3)
+        for pdf_page, page in zip(reader.pages, pages):
+            # 300 dpi, in points of 1/72 inch
+            self.assertEqual([float(n) for n in pdf_page.mediabox], [0, 0, page.width * 72 / 300,
+                                                                    page.height * 72 / 300])
+
+    def test_flate_pages_decode_to_their_pixels(self):
+        pages = [make_page(seed=0), make_page(mode="L", seed=1), make_page(seed=2)]
+        reader = self.write_pdf(pages, encoding="flate", compress_level=6)
+        for pdf_page, page in zip(reader.pages, pages):
+            image = pdf_page["/Resources"]["/XObject"]["/Im0"]
+            self.assertEqual(image["/Filter"], "/FlateDecode")
+            self.assertEqual((image["/Width"], image["/Height"]), page.size)
+            self.assertEqual(image.get_data(), page.tobytes())
+
+    def test_jpeg_pages_decode_to_their_pixels(self):
+        pages = [make_page(seed=i) for i in range(3)]
+        reader = self.write_pdf(pages, encoding="jpeg", quality=90)
+        for pdf_page, page in zip(reader.pages, pages):
+            image = pdf_page["/Resources"]["/XObject"]["/Im0"]
+            self.assertEqual(image["/Filter"], "/DCTDecode")
+            # The stream is the JPEG itself, which decodes to the same pixels as the page saved at that quality
+            expected = io.BytesIO()
+            page.save(expected, format="JPEG", quality=90)
+            with Image.open(io.BytesIO(image.get_data())) as decoded, Image.open(expected) as expected:
+                self.assertEqual(decoded.size, page.size)
+                self.assertEqual(decoded.tobytes(), expected.tobytes())
+
+    def test_rgba_pages_are_flattened_to_rgb(self):
+        page = make_page(mode="RGBA")
+        reader = self.write_pdf([page])
+        image = reader.pages[0]["/Resources"]["/XObject"]["/Im0"]
+        self.assertEqual(image["/ColorSpace"], "/DeviceRGB")
+        self.assertEqual(image.get_data(), page.convert("RGB").tobytes())
+
+    def test_invalid_encoding(self):
+        with self.assertRaises(ValueError):
+            self.write_pdf([make_page()], encoding="png")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import random
+import tomllib
+import unittest
+from functools import lru_cache
+from glob import glob
+from typing import List, Tuple
+
+from PIL import ImageFont
+
+from pil_helpers import TextBox, resolve_font, TEXT_FONT, DEFAULT_FONT, FONTS_FOLDER_VARIABLE
+
+# Random boxes checked against the original loop. Each takes a few dozen milliseconds with the original.
+RANDOM_BOX_COUNT = 150
+
+
+@lru_cache(maxsize=None)
+def build_original_font(font_name: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font_name, font_size)
+
+
+def wrap_text_originally(text: str, font: ImageFont.FreeTypeFont, max_width: int = 0) -> str:
+    """
+    TextBox.wrap_text as it was before word widths were cached, measuring the whole line for every word added.
+    """
+    text = text.strip("\n")
+    if max_width <= 0:
+        return text
+
+    temp = ""
+    wrapped_text = ""
+
+    for w in text.split(' '):
+        if "\n" in w:
+            wrapped_text += temp.strip(' ')
+            width = font.getlength("{} {}".format(temp, w.partition('\n')[0]))
+            if width > max_width:
+                wrapped_text += "\n"
+            else:
+                wrapped_text += " "
+            par = w.rpartition('\n')
+            wrapped_text += par[0] + "\n"
+            temp = par[2] + " "
+        else:
+            width = font.getlength(u"{0} {1}".format(temp, w))
+            if width > max_width:
+                wrapped_text += temp.strip(' ') + "\n"
+                temp = ""
+            temp += w + " "
+    return wrapped_text + temp.strip(' ')
+
+
+def shrink_font_one_size_at_a_time(text: str, font_name: str, starting_font_size: int, width: int, height: int,
+                                   use_height_for_text_wrap: bool) -> Tuple[int, List[str]]:
+    """
+    The original fitting loop and TextBox.get_text_block_size, copied here so that shrink_font_until_text_fits is
+    checked against them rather than against the code it uses.
+
+    @return (int, [str]): The font size and the wrapped lines.
+    """
+    font_size = starting_font_size
+    while font_size > 0:
+        font = build_original_font(font_name, font_size)
+        text_lines = wrap_text_originally(text, font, height if use_height_for_text_wrap else width).split("\n")
+        block_width = max(font.getsize(line)[0] for line in text_lines)
+        block_height = len(text_lines) * (font.font.ascent + font.font.descent)
+        if block_width <= width and block_height <= height:
+            return font_size, text_lines
+        font_size -= 1
+    raise ValueError("Text is too big to fit in the text box at any font size")
+
+
+@unittest.skipUnless(os.environ.get(FONTS_FOLDER_VARIABLE), f"Needs the fonts, in ${FONTS_FOLDER_VARIABLE}")
+class ShrinkFontUntilTextFitsTest(unittest.TestCase):
+
+    def assert_same_size_as_original(self, text: str, font_name: str, starting_font_size: int, width: int,
+                                     height: int, use_height_for_text_wrap: bool = False):
+        font_name = resolve_font(font_name)
+        box = TextBox(0, 0, width, height, font_name=font_name, use_height_for_text_wrap=use_height_for_text_wrap)
+        try:
+            expected = shrink_font_one_size_at_a_time(text, font_name, starting_font_size, width, height,
+                                                      use_height_for_text_wrap)
+        except ValueError:
+            with self.assertRaises(ValueError):
+                box.shrink_font_until_text_fits(text, font_name, starting_font_size, width, height,
+                                                use_fit_cache=False)
+            return
+        text_lines, font = box.shrink_font_until_text_fits(text, font_name, starting_font_size, width, height,
+                                                           use_fit_cache=False)
+        self.assertEqual((font.size, text_lines), expected, f"{text!r} in {width}x{height} from {starting_font_size}")
+
+    def test_size_that_fails_above_a_smaller_fit(self):
+        # Fits at 32, but not at 27, 24 or 23, where getsize makes a line wider than the box
+        self.assert_same_size_as_original("and thunder finish you minute must that wood at 1d6 and action",
+                                          DEFAULT_FONT, 45, 224, 237, use_height_for_text_wrap=True)
+        self.assert_same_size_as_original(
+            "shares of levels, speed. instantaneously proficiency instantaneously the your ki as Object only as the "
+            "draw can 6th Perception and fire,", TEXT_FONT, 20, 292, 316, use_height_for_text_wrap=True)
+
+    def test_random_boxes(self):
+        words = " ".join(open_description(path) for path in sorted(glob("classes/*/abilities/*.toml"))).split()
+        rng = random.Random(0)
+        for _ in range(RANDOM_BOX_COUNT):
+            with self.subTest():
+                self.assert_same_size_as_original(
+                    " ".join(rng.choices(words, k=rng.randint(1, 80))), rng.choice([TEXT_FONT, DEFAULT_FONT]),
+                    rng.randint(4, 70), rng.randint(30, 900), rng.randint(20, 1000),
+                    use_height_for_text_wrap=rng.random() < 0.1)
+
+
+def open_description(toml_path: str) -> str:
+    with open(toml_path, "rb") as f:
+        return tomllib.load(f).get("description", "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import base64
+import io
+import json
+import os
+import threading
+import tomllib
+import unittest
+import urllib.error
+import urllib.request
+from glob import glob
+from typing import Any, Tuple
+
+from PIL import Image
+
+from pil_helpers import FONTS_FOLDER_VARIABLE
+from server import make_server
+
+
+class RenderServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Port 0 picks a free port, so the test never clashes with a server that's already running
+        cls.server = make_server(port=0, warm=False)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def post(self, request: Any) -> Tuple[int, bytes]:
+        http_request = urllib.request.Request(f"http://127.0.0.1:{self.server.server_port}/render",
+                                              data=json.dumps(request).encode("utf-8"),
+                                              headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(http_request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    @unittest.skipUnless(os.environ.get(FONTS_FOLDER_VARIABLE), f"Needs the fonts, in ${FONTS_FOLDER_VARIABLE}")
+    def test_render(self):
+        with open(sorted(glob(os.path.join("classes", "common", "abilities", "*.toml")))[0], "rb") as f:
+            card = tomllib.load(f)
+        status, body = self.post({"class": "common", "cards": [card]})
+        self.assertEqual(status, 200, body)
+        result = json.loads(body)["cards"][0]
+        self.assertEqual(result["name"], card.get("name"))
+        with Image.open(io.BytesIO(base64.b64decode(result["png"]))) as im:
+            self.assertEqual(im.format, "PNG")
+
+    def test_bad_requests(self):
+        card = {"name": "Test", "description": "Test"}
+        bad_requests = {
+            "list instead of an object": [card],
+            "no cards": {"class": "common", "cards": []},
+            "card that isn't an object": {"class": "common", "cards": ["Test"]},
+            "unknown class": {"class": "nope", "cards": [card]},
+            "unknown output": {"class": "common", "cards": [card], "output": "gif"},
+            "minimum_level that isn't a number": {"class": "common", "cards": [card], "minimum_level": "a"},
+            "minimum_level below 1": {"class": "common", "cards": [card], "minimum_level": 0},
+            "compress_level above 9": {"class": "common", "cards": [card], "compress_level": 42},
+            "compress_level that isn't whole": {"class": "common", "cards": [card], "compress_level": 1.5},
+            "quality above 95": {"class": "common", "cards": [card], "quality": 100},
+            "quality below 1": {"class": "common", "cards": [card], "quality": 0},
+            "palette with too many colors": {"class": "common", "cards": [card], "palette": 1000},
+        }
+        for description, request in bad_requests.items():
+            with self.subTest(description):
+                status, body = self.post(request)
+                self.assertEqual(status, 400, body)
+                self.assertIn("error", json.loads(body))
+
+
+if __name__ == "__main__":
+    unittest.main()
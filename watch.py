@@ -0,0 +1,179 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from glob import glob
+from typing import List, Dict, Set, Tuple, Iterator, Optional
+
+from pil_helpers import get_file_signature
+
+# Everything that a card's look depends on and that gets edited while writing cards. Class modules and the layout
+# code aren't watched, since a warm process keeps running the code it started with.
+WATCH_PATTERNS = [
+    os.path.join("classes", "*", "abilities", "*.toml"),
+    os.path.join("templates", "*.png"),
+    os.path.join("classes", "*", "templates", "*.png"),
+    os.path.join("classes", "*", "symbol.jpeg"),
+]
+# Editors often save a file in several steps (write a temp file, rename it, touch it), so changes are gathered until
+# things have been quiet for this long
+DEBOUNCE_SECONDS = 0.05
+POLL_INTERVAL_SECONDS = 0.25
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def get_watched_files(patterns: List[str] = WATCH_PATTERNS) -> Set[str]:
+    return {path for pattern in patterns for path in glob(pattern)}
+
+
+def get_watched_folders(patterns: List[str] = WATCH_PATTERNS) -> Set[str]:
+    return {folder for pattern in patterns for folder in glob(os.path.dirname(pattern)) if os.path.isdir(folder)}
+
+
+class PollingWatcher:
+    """
+    Finds changed files by comparing the size and mtime of every watched file on a timer. Works everywhere.
+    """
+
+    def __init__(self, patterns: List[str] = WATCH_PATTERNS, interval: float = POLL_INTERVAL_SECONDS):
+        self.patterns, self.interval = patterns, interval
+        self._signatures = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        signatures = {}
+        for path in get_watched_files(self.patterns):
+            try:
+                signatures[path] = get_file_signature(path)
+            except OSError:
+                # Deleted between the glob and the stat
+                pass
+        return signatures
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Blocks until a watched file is added, changed or removed, or until timeout seconds have passed.
+
+        @return {str}: Paths of the files that changed. Empty if the timeout ran out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            signatures = self._scan()
+            changed = {path for path in signatures.keys() | self._signatures.keys()
+                       if signatures.get(path) != self._signatures.get(path)}
+            self._signatures = signatures
+            if changed:
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return set()
+                time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Asks the Linux kernel to report changes to the watched folders, so that nothing is polled and changes are seen
+    right away. Only paths matching the watch patterns are reported.
+    """
+
+    def __init__(self, patterns: List[str] = WATCH_PATTERNS):
+        self.patterns = patterns
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._folders = {}
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        for folder in get_watched_folders(patterns):
+            wd = self._add_watch(self._fd, os.fsencode(folder), mask)
+            if wd < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+            self._folders[wd] = folder
+
+    def _read_events(self) -> Set[str]:
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, _, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+                offset += name_length
+                if wd in self._folders and name:
+                    changed.add(os.path.join(self._folders[wd], name))
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Blocks until a watched file is added, changed or removed, or until timeout seconds have passed.
+
+        @return {str}: Paths of the files that changed. Empty if the timeout ran out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        watched = get_watched_files(self.patterns)
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not select.select([self._fd], [], [], remaining)[0]:
+                return set()
+            # Files that are gone don't match the patterns anymore, so check them against the earlier glob too
+            changed = self._read_events()
+            watched |= get_watched_files(self.patterns)
+            changed &= watched
+            if changed:
+                return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def make_watcher(patterns: List[str] = WATCH_PATTERNS, polling: bool = False):
+    """
+    @return InotifyWatcher or PollingWatcher: inotify on Linux, unless polling is asked for or inotify can't be
+        used (e.g. on some network filesystems, or when out of watches), polling otherwise.
+    """
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(patterns)
+        except (OSError, AttributeError) as e:
+            print(f"Can't use inotify ({e}), polling for changes instead")
+    return PollingWatcher(patterns)
+
+
+def iter_changes(watcher, debounce: float = DEBOUNCE_SECONDS) -> Iterator[Set[str]]:
+    """
+    Yields each batch of changed paths, once the watched files have stopped changing for debounce seconds.
+    """
+    while True:
+        changed = watcher.wait()
+        while True:
+            more = watcher.wait(timeout=debounce)
+            if not more:
+                break
+            changed |= more
+        yield changed